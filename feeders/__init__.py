@@ -1,4 +1,13 @@
 from . import tools
 from . import feeder
 from . import posenc
+from . import streams
+from . import stats
+from . import batch_augment
+from . import pack
+from . import quantize
+from . import shared
+from . import sampler
+from . import metrics
+from . import fileio
 #from . import feeder_kinetics
\ No newline at end of file
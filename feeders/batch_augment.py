@@ -0,0 +1,151 @@
+"""Batched versions of the Feeder augmentations.
+
+They act on a collated (N, C, T, V, M) tensor on whatever device it lives,
+drawing the random parameters per sample, and reproduce the distribution of
+the per-sample NumPy path in Feeder.__getitem__, which
+tests/test_batch_augment.py checks transform by transform.
+"""
+
+import torch
+
+from feeders.feeder import flip_index
+
+
+def _uniform(n, low, high, data, generator=None):
+    r = torch.rand(n, generator=generator, device=data.device, dtype=data.dtype)
+    return r * (high - low) + low
+
+
+def _choice(candidates, shape, data, generator=None):
+    candidates = torch.as_tensor(candidates, dtype=data.dtype, device=data.device)
+    idx = torch.randint(len(candidates), shape, generator=generator, device=data.device)
+    return candidates[idx]
+
+
+def random_mirror(data, p=0.5, is_vector=False, generator=None):
+    # input: N,C,T,V,M
+    N, C, T, V, M = data.shape
+    assert V == 27
+    flip = _uniform(N, 0.0, 1.0, data, generator) > p
+    flipped = data[:, :, :, torch.as_tensor(flip_index, device=data.device)]
+    if is_vector:
+        flipped[:, 0] = -flipped[:, 0]
+    else:
+        flipped[:, 0] = 512 - flipped[:, 0]  # input size 512*512
+    return torch.where(flip.view(N, 1, 1, 1, 1), flipped, data)
+
+
+def center(data, is_vector=False):
+    # input: N,C,T,V,M, centre x/y on the mean position of joint 0
+    assert data.shape[1] == 3
+    data = data.clone()
+    origin = data[:, 0:2, :, 0, 0].mean(dim=2).view(-1, 2, 1, 1)
+    if is_vector:
+        data[:, 0:2, :, 0] -= origin
+    else:
+        data[:, 0:2] -= origin.unsqueeze(-1)
+    return data
+
+
+def random_shift(data, is_vector=False, generator=None):
+    # input: N,C,T,V,M, one offset in [-10, 10) per sample and axis
+    N = data.shape[0]
+    data = data.clone()
+    offset = _uniform(N * 2, -10.0, 10.0, data, generator).view(N, 2, 1, 1)
+    if is_vector:
+        data[:, 0:2, :, 0] += offset
+    else:
+        data[:, 0:2] += offset.unsqueeze(-1)
+    return data
+
+
+def random_move(
+    data,
+    angle_candidate=[-10.0, -5.0, 0.0, 5.0, 10.0],
+    scale_candidate=[0.9, 1.0, 1.1],
+    transform_candidate=[-0.2, -0.1, 0.0, 0.1, 0.2],
+    move_time_candidate=[1],
+    generator=None,
+):
+    # input: N,C,T,V,M, batched tools.random_move
+    N, C, T, V, M = data.shape
+    move_time = _choice(move_time_candidate, (N, 1), data, generator)
+    max_nodes = max(move_time_candidate) + 1
+
+    # key frames round(k * T / move_time), padded with T, as in tools.random_move
+    k = torch.arange(max_nodes, device=data.device, dtype=data.dtype)
+    node = torch.where(
+        k < move_time, torch.round(k * T / move_time), torch.full_like(k, T)
+    )
+    t = torch.arange(T, device=data.device, dtype=data.dtype)
+    seg = (node.unsqueeze(1) <= t.view(1, T, 1)).sum(-1) - 1  # N,T
+    start = node.gather(1, seg)
+    length = node.gather(1, seg + 1) - start
+    frac = (t - start) / (length - 1).clamp(min=1)
+
+    def interp(candidates):
+        value = _choice(candidates, (N, max_nodes), data, generator)
+        v0, v1 = value.gather(1, seg), value.gather(1, seg + 1)
+        return v0 + (v1 - v0) * frac
+
+    a = interp(angle_candidate) * torch.pi / 180
+    s = interp(scale_candidate)
+    t_x = interp(transform_candidate)
+    t_y = interp(transform_candidate)
+
+    x, y = data[:, 0], data[:, 1]
+    cos = (torch.cos(a) * s).view(N, T, 1, 1)
+    sin = (torch.sin(a) * s).view(N, T, 1, 1)
+    data = data.clone()
+    data[:, 0] = cos * x - sin * y + t_x.view(N, T, 1, 1)
+    data[:, 1] = sin * x + cos * y + t_y.view(N, T, 1, 1)
+    return data
+
+
+class BatchAugment:
+    """Apply the Feeder augmentations to a whole batch, in Feeder order."""
+
+    def __init__(
+        self,
+        random_mirror=False,
+        random_mirror_p=0.5,
+        normalization=False,
+        random_shift=False,
+        random_move=False,
+        is_vector=False,
+        bone_stream=False,
+        generator=None,
+    ):
+        self.random_mirror = random_mirror
+        self.random_mirror_p = random_mirror_p
+        self.normalization = normalization
+        self.random_shift = random_shift and not bone_stream
+        self.random_move = random_move
+        self.is_vector = is_vector
+        self.generator = generator
+
+    @classmethod
+    def from_feeder(cls, feeder, generator=None):
+        return cls(
+            random_mirror=feeder.random_mirror,
+            random_mirror_p=feeder.random_mirror_p,
+            normalization=feeder.normalization,
+            random_shift=feeder.random_shift,
+            random_move=feeder.random_move,
+            is_vector=feeder.is_vector,
+            bone_stream=feeder.bone_stream,
+            generator=generator,
+        )
+
+    def __call__(self, data):
+        if self.random_mirror:
+            data = random_mirror(
+                data, self.random_mirror_p, self.is_vector, self.generator
+            )
+        if self.normalization:
+            data = center(data, self.is_vector)
+        if self.random_shift:
+            data = random_shift(data, self.is_vector, self.generator)
+        if self.random_move:
+            data = random_move(data, generator=self.generator)
+        return data
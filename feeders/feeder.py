@@ -11,6 +11,13 @@ sys.path.extend(["../"])
 import os
 from einops import rearrange
 from feeders import tools
+from feeders import streams
+from feeders import stats
+from feeders import pack
+from feeders import quantize
+from feeders import shared
+from feeders import metrics
+from feeders.sampler import TemporalSampler
 
 flip_index = np.concatenate(
     (
@@ -40,6 +47,13 @@ class Feeder(Dataset):
         lap_pe=False,
         bone_stream=False,
         motion_stream=False,
+        use_materialized=False,
+        stats_workers=0,
+        batch_augment=False,
+        storage=None,
+        shared_memory=False,
+        sampler=None,
+        valid_span=False,
         num_class=2000,
     ):
         """
@@ -53,7 +67,14 @@ class Feeder(Dataset):
         :param normalization: If true, normalize input sequence
         :param debug: If true, only use the first 100 samples
         :param use_mmap: If true, use mmap mode to load data, which can save the running memory
-        :param lap_pe: If true, use laplacian positional encoding (only for LapPE attention model)
+        :param lap_pe: If true, use laplacian positional encoding (only for LapPE attention model). "batched" returns plain samples and builds the graph batch in collate_fn. Either way the batches are graphs for an external model, not input for main.Processor
+        :param use_materialized: If true, load the bone/motion stream precomputed by feeders.materialize instead of deriving it per sample
+        :param stats_workers: Number of processes used to compute the normalization statistics
+        :param batch_augment: If true, return samples before mirror/normalization/shift/move, which are applied to the whole batch by feeders.batch_augment
+        :param storage: "float16" or "int16" to read the reduced-precision copy written by feeders.quantize
+        :param shared_memory: If true, attach to a copy of the data in POSIX shared memory that is loaded once for all workers and concurrent runs
+        :param sampler: A feeders.sampler.TemporalSampler, or a dict of its arguments (e.g. {seed: 1}), used instead of tools.uniform_sample_np/random_sample_np
+        :param valid_span: If true, sample only between the first and last non-null frame, read from a *_lengths.npy sidecar computed once
         """
 
         self.debug = debug
@@ -67,18 +88,29 @@ class Feeder(Dataset):
         self.use_mmap = use_mmap
         self.random_mirror = random_mirror
         self.random_mirror_p = random_mirror_p
+        self.bone_stream = bone_stream
+        self.motion_stream = motion_stream
+        self.use_materialized = use_materialized and (bone_stream or motion_stream)
+        self.storage = storage
+        self.shared_memory = shared_memory
+        if isinstance(sampler, dict):
+            sampler = TemporalSampler(window_size, **sampler)
+        self.sampler = sampler
+        self.valid_span = valid_span
         self.load_data()
         self.is_vector = is_vector
         self.lap_pe = lap_pe
-        self.bone_stream = bone_stream
-        self.motion_stream = motion_stream
+        self.collate_fn = None
         self.num_class = num_class
+        self.stats_workers = stats_workers
+        self.batch_augment = batch_augment
+        if self.batch_augment and self.lap_pe:
+            raise ValueError("batch_augment is not supported with lap_pe")
         if normalization:
             self.get_mean_map()
 
         if self.lap_pe:
             from feeders import posenc
-            from torch_geometric.data import Data
             import torch_geometric.transforms as T
 
             edge_index_per_frame = torch.tensor(Graph().neighbor).long()
@@ -87,29 +119,23 @@ class Feeder(Dataset):
             ).T
             self.num_nodes = self.edge_index.max() + 1
 
-            if os.path.exists(f"data/eig_vals.pt"):
-                self.eig_vals = torch.load(f"data/eig_vals.pt")
-                self.eig_vecs = torch.load(f"data/eig_vecs.pt")
-            else:
-                pe_enabled_list = ["LapPE"]
-                data = Data(
-                    edge_index=self.edge_index,
-                    num_nodes=self.num_nodes,
-                )
-                self.eig_vals, self.eig_vecs = posenc.compute_posenc_stats(
-                    data,
-                    pe_enabled_list,
-                    is_undirected=True,
-                    laplacian_norm_type="none",
-                    max_freqs=8,
-                    eigvec_norm="L2",
-                )
-
-                # save eig_vals and eig_vecs
-                torch.save(self.eig_vals, f"data/eig_vals.pt")
-                torch.save(self.eig_vecs, f"data/eig_vecs.pt")
+            # frames are disconnected copies of the skeleton, so the spectrum
+            # follows from the 27-node graph in closed form
+            self.eig_vals, self.eig_vecs = posenc.product_lap_pe(
+                edge_index_per_frame.T,
+                27,
+                self.window_size,
+                temporal="none",
+                laplacian_norm_type="none",
+                max_freqs=8,
+                eigvec_norm="L2",
+            )
 
             self.transform = T.Compose([T.Distance()])
+            if self.lap_pe == "batched":
+                self.collate_fn = posenc.LapPECollate(
+                    self.edge_index, self.eig_vecs, self.eig_vals, self.window_size
+                )
 
         print(len(self.label))
 
@@ -125,40 +151,95 @@ class Feeder(Dataset):
                 self.sample_name, self.label = pickle.load(f, encoding="latin1")
 
         # load data
-        if self.use_mmap:
-            self.data = np.load(self.data_path, mmap_mode="r", allow_pickle=True)
+        data_path = self.stream_data_path()
+        self.scale = None
+        if self.storage:
+            self.scale = quantize.load_scale(data_path, self.storage)
+            data_path = quantize.quantized_paths(data_path, self.storage)[0]
+        self.data_file = data_path
+        if self.shared_memory:
+            self.data = shared.cache.get(data_path)
+        elif self.use_mmap or self.use_materialized:
+            self.data = np.load(data_path, mmap_mode="r", allow_pickle=True)
         else:
-            self.data = np.load(self.data_path)
+            self.data = np.load(data_path)
+        self.spans = pack.load_spans(self.data_path) if self.valid_span else None
         if self.debug:
             self.label = self.label[0:100]
             self.data = self.data[0:100]
             self.sample_name = self.sample_name[0:100]
+            if self.spans is not None:
+                self.spans = self.spans[0:100]
+
+    def stream_data_path(self):
+        if self.use_materialized:
+            return streams.stream_path(
+                self.data_path,
+                streams.stream_name(self.bone_stream, self.motion_stream),
+            )
+        return self.data_path
 
     def get_mean_map(self):
-        data = self.data
-        N, C, T, V, M = data.shape
-        self.mean_map = (
-            data.mean(axis=2, keepdims=True).mean(axis=4, keepdims=True).mean(axis=0)
-        )
-        self.std_map = (
-            data.transpose((0, 2, 4, 1, 3))
-            .reshape((N * T * M, C * V))
-            .std(axis=0)
-            .reshape((C, 1, V, 1))
+        self.mean_map, self.std_map = stats.mean_std(
+            self.data_file,
+            num_samples=len(self.data),
+            num_workers=self.stats_workers,
         )
+        if self.scale is not None:
+            self.mean_map = self.mean_map * self.scale.reshape(-1, 1, 1, 1)
+            self.std_map = self.std_map * self.scale.reshape(-1, 1, 1, 1)
 
     def __len__(self):
         return len(self.label)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared_memory:
+            # spawned workers attach to the segment instead of unpickling a copy
+            del state["data"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_memory:
+            self.data = shared.cache.get(self.data_file)
+
     def __iter__(self):
         return self
 
-    def __getitem__(self, index):
+    def get_sample(self, index):
         data_numpy = self.data[index]  # C T V M
-        label = self.label[index]
-        data_numpy = np.array(data_numpy)
+        if self.storage:
+            data_numpy = quantize.dequantize(data_numpy, self.scale)
+        else:
+            data_numpy = np.array(data_numpy)
 
         data_numpy[np.isinf(data_numpy)] = 0  # For MLASL
+        return data_numpy
+
+    def get_stream(self, index):
+        data_numpy = self.get_sample(index)
+        if self.spans is None:
+            return self.derive(data_numpy)
+        begin, end = self.spans[index]
+        return self.derive(data_numpy[:, begin:end], trimmed=True)
+
+    def derive(self, data_numpy, trimmed=False):
+        # motion is taken after trimming, so the last valid frame gets a zero
+        # motion frame instead of the jump into the padding
+        if not self.use_materialized:
+            return streams.derive(
+                data_numpy,
+                bone_stream=self.bone_stream,
+                motion_stream=self.motion_stream,
+            )
+        if trimmed and self.motion_stream:
+            data_numpy[:, -1] = 0
+        return data_numpy
+
+    def __getitem__(self, index):
+        data_numpy = self.get_stream(index)
+        label = self.label[index]
 
         # remove null frames
         """index = (data_numpy.sum(-1).sum(-1).sum(0) != 0)
@@ -187,51 +268,12 @@ class Feeder(Dataset):
                     data_numpy[i_p, i_f, i_j] = np.dot(matrix_x, joint)
         data_numpy = data_numpy.transpose(3,1,2,0)  # C T V M"""
 
-        if self.bone_stream:
-            ori_data = data_numpy
-            for v1, v2 in (
-                (5, 6),
-                (5, 7),
-                (6, 8),
-                (8, 10),
-                (7, 9),
-                (9, 11),
-                (12, 13),
-                (12, 14),
-                (12, 16),
-                (12, 18),
-                (12, 20),
-                (14, 15),
-                (16, 17),
-                (18, 19),
-                (20, 21),
-                (22, 23),
-                (22, 24),
-                (22, 26),
-                (22, 28),
-                (22, 30),
-                (24, 25),
-                (26, 27),
-                (28, 29),
-                (30, 31),
-                (10, 12),
-                (11, 22),
-            ):
-                data_numpy[:, :, v2 - 5, :] = (
-                    ori_data[:, :, v2 - 5, :] - ori_data[:, :, v1 - 5, :]
-                )
-
-        if self.motion_stream:
-            T = data_numpy.shape[1]
-            ori_data = data_numpy
-            for t in range(T - 1):
-                data_numpy[:, t, :, :] = ori_data[:, t + 1, :, :] - ori_data[:, t, :, :]
-            data_numpy[:, T - 1, :, :] = 0
-
         # if self.random_choose:
         #    data_numpy = tools.random_choose(data_numpy, self.window_size)
 
-        if self.random_choose:
+        if self.sampler is not None:
+            data_numpy = self.sampler(data_numpy, random=self.random_choose)
+        elif self.random_choose:
             data_numpy = tools.random_sample_np(data_numpy, self.window_size)
         else:
             data_numpy = tools.uniform_sample_np(data_numpy, self.window_size)
@@ -242,6 +284,9 @@ class Feeder(Dataset):
         else:
             data_numpy = tools.random_choose_simple(data_numpy, self.window_size)"""
 
+        if self.batch_augment:
+            return data_numpy, label, index
+
         if self.random_mirror:
             if random.random() > self.random_mirror_p:
                 assert data_numpy.shape[2] == 27
@@ -288,7 +333,7 @@ class Feeder(Dataset):
         if self.random_move:
             data_numpy = tools.random_move(data_numpy)
 
-        if self.lap_pe:
+        if self.lap_pe and self.lap_pe != "batched":
             from torch_geometric.data import Data
 
             data = torch.tensor(data_numpy).float()
@@ -314,23 +359,61 @@ class Feeder(Dataset):
         return data_numpy, label, index
 
     def top_k(self, score, top_k):
-        rank = score.argsort()
-        hit_top_k = [l in rank[i, -top_k:] for i, l in enumerate(self.label)]
-        return sum(hit_top_k) * 1.0 / len(hit_top_k)
+        return metrics.top_k_accuracy(score, self.label, [top_k])[top_k][0]
 
     def per_class_acc_top_k(self, score, top_k):
-        rank = score.argsort()
-        hit_top_k = [
-            l in rank[i, -top_k:] for i, l in enumerate(self.label)
-        ]
-        acc = [0 for c in range(self.num_class)]
-        for c in range(self.num_class):
-            hit_label = [l == c for l in self.label]
-            acc[c] = np.sum(
-                np.array(hit_top_k).astype(np.float32)
-                * np.array(hit_label).astype(np.float32)
-            ) / self.label.count(c)
-        return np.mean(acc)
+        return metrics.top_k_accuracy(score, self.label, [top_k], self.num_class)[
+            top_k
+        ][1]
+
+
+class PackedFeeder(Feeder):
+    """Feeder over the variable-length format written by feeders.pack.
+
+    Takes the same arguments as Feeder. data_path still names the padded
+    *_data_joint.npy; the packed buffer and its index (which also holds the
+    labels) are expected next to it. Samples only contain their valid frames,
+    so temporal sampling never picks padding. As with Feeder(valid_span=True),
+    a motion stream ends with a zero frame instead of the jump into padding.
+    """
+
+    def load_data(self):
+        if self.storage:
+            raise ValueError("use feeders.pack --dtype float16 for packed data")
+        self.data_file, index_path = pack.packed_paths(self.stream_data_path())
+        index = np.load(index_path)
+        self.offset = index["offset"]
+        self.length = index["length"]
+        self.label = index["label"].tolist()
+        self.sample_name = index["sample_name"].tolist()
+        self.spans = None  # packed samples only hold their valid frames
+
+        if self.shared_memory:
+            self.data = shared.cache.get(self.data_file)
+        elif self.use_mmap or self.use_materialized:
+            self.data = np.load(self.data_file, mmap_mode="r")
+        else:
+            self.data = np.load(self.data_file)
+        if self.debug:
+            self.label = self.label[0:100]
+            self.sample_name = self.sample_name[0:100]
+            self.offset = self.offset[0:100]
+            self.length = self.length[0:100]
+
+    def get_mean_map(self):
+        self.mean_map, self.std_map = stats.mean_std(
+            self.data_file,
+            num_samples=int(self.offset[-1] + self.length[-1]),
+            num_workers=self.stats_workers,
+        )
+
+    def get_sample(self, index):
+        begin = self.offset[index]
+        data_numpy = self.data[begin : begin + self.length[index]]  # T C V M
+        return np.array(data_numpy.transpose(1, 0, 2, 3), dtype=np.float32)
+
+    def get_stream(self, index):
+        return self.derive(self.get_sample(index), trimmed=True)
 
 
 def import_class(name):
@@ -0,0 +1,74 @@
+"""File helpers shared by the offline dataset tools.
+
+feeders.materialize, feeders.pack and feeders.quantize take the same
+--dataset/--data-dir/--streams/--splits/--chunk-size arguments and walk the
+padded (N, C, T, V, M) arrays chunk by chunk. Every file they or the caches
+write goes through `atomic_save`, so concurrent runs never see a partial file.
+"""
+
+import argparse
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def tmp_path(path):
+    # unique per process, keeping the extension np.save / np.savez would append
+    return "{}.{}.tmp{}".format(path, os.getpid(), os.path.splitext(path)[1])
+
+
+@contextmanager
+def atomic_save(path):
+    """Yield a temporary path that replaces `path` once the block succeeds."""
+    tmp = tmp_path(path)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def iter_chunks(data, chunk_size=256, dtype=None):
+    """(start, chunk) over the first axis, infs zeroed like Feeder.get_sample."""
+    for start in range(0, len(data), chunk_size):
+        chunk = np.array(data[start : start + chunk_size], dtype=dtype)
+        chunk[np.isinf(chunk)] = 0
+        yield start, chunk
+
+
+def get_parser(description, streams="joint", streams_help=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--dataset", required=True, help="dataset name")
+    parser.add_argument("--data-dir", default="./data", help="root of the datasets")
+    parser.add_argument(
+        "--streams",
+        default=streams,
+        help=streams_help
+        or "comma separated streams, non-joint ones must be materialized",
+    )
+    parser.add_argument(
+        "--splits", default="train,val", help="comma separated data splits"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=256,
+        help="number of samples held in memory at once",
+    )
+    return parser
+
+
+def stream_names(arg):
+    return [n.strip() for n in arg.streams.split(",") if n.strip()]
+
+
+def split_paths(arg):
+    """(joint data, label) paths of every --splits entry."""
+    root = os.path.join(arg.data_dir, arg.dataset)
+    for split in arg.splits.split(","):
+        yield (
+            os.path.join(root, f"{split}_data_joint.npy"),
+            os.path.join(root, f"{split}_label.pkl"),
+        )
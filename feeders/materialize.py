@@ -0,0 +1,107 @@
+"""Precompute derived input streams next to the joint data.
+
+    python -m feeders.materialize --dataset WLASL2000 --streams bone,motion,bone_motion
+
+writes ./data/WLASL2000/{train,val}_data_{bone,motion,bone_motion}.npy, which
+the Feeder picks up with `use_materialized: True`.
+"""
+
+import numpy as np
+
+from feeders import fileio
+from feeders import streams
+
+
+def materialize(data_path, name, chunk_size=256):
+    bone_stream, motion_stream = streams.STREAMS[name]
+    out_path = streams.stream_path(data_path, name)
+
+    data = np.load(data_path, mmap_mode="r")
+    with fileio.atomic_save(out_path) as tmp_path:
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=data.dtype, shape=data.shape
+        )
+        # same preprocessing as Feeder.__getitem__, one chunk at a time
+        for start, chunk in fileio.iter_chunks(data, chunk_size):
+            out[start : start + len(chunk)] = streams.derive(
+                chunk, bone_stream=bone_stream, motion_stream=motion_stream
+            )
+        out.flush()
+        del out
+    return out_path
+
+
+def verify(data_path, label_path, name, num_samples=64, seed=0):
+    """Compare the materialized file against the per-sample Feeder path.
+
+    Both sides are read through feeders.feeder.Feeder, once deriving the
+    stream from the joints and once with `use_materialized=True`.
+
+    Returns the indices of mismatching samples (empty if bit-for-bit equal).
+    """
+    from feeders.feeder import Feeder
+
+    bone_stream, motion_stream = streams.STREAMS[name]
+    kwargs = dict(
+        data_path=data_path,
+        label_path=label_path,
+        bone_stream=bone_stream,
+        motion_stream=motion_stream,
+    )
+    reference = Feeder(use_materialized=False, **kwargs)
+    stored = Feeder(use_materialized=True, **kwargs)
+    assert (
+        reference.data.shape == stored.data.shape
+        and reference.data.dtype == stored.data.dtype
+    )
+
+    if num_samples < 0 or num_samples >= len(reference):
+        indices = np.arange(len(reference))
+    else:
+        rng = np.random.default_rng(seed)
+        indices = np.sort(rng.choice(len(reference), num_samples, replace=False))
+
+    return [
+        int(i)
+        for i in indices
+        if not np.array_equal(reference.get_stream(i), stored.get_stream(i))
+    ]
+
+
+def get_parser():
+    parser = fileio.get_parser(
+        "Precompute bone / motion streams of a skeleton dataset",
+        streams="bone,motion,bone_motion",
+        streams_help="comma separated streams out of {}".format(
+            ", ".join(n for n in streams.STREAMS if n != "joint")
+        ),
+    )
+    parser.add_argument(
+        "--verify",
+        type=int,
+        default=64,
+        help="number of random samples checked against the Feeder path, -1 for all, 0 to skip",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    arg = get_parser().parse_args()
+    names = fileio.stream_names(arg)
+    for n in names:
+        if n not in streams.STREAMS or n == "joint":
+            raise ValueError("unknown stream {}".format(n))
+
+    for data_path, label_path in fileio.split_paths(arg):
+        for n in names:
+            out_path = materialize(data_path, n, chunk_size=arg.chunk_size)
+            print("wrote", out_path)
+            if arg.verify:
+                mismatch = verify(data_path, label_path, n, num_samples=arg.verify)
+                if mismatch:
+                    raise RuntimeError(
+                        "{} differs from the Feeder path at samples {}".format(
+                            out_path, mismatch[:10]
+                        )
+                    )
+                print("verified", out_path)
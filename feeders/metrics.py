@@ -0,0 +1,163 @@
+"""Top-k and per-class accuracy of a whole score matrix in one pass.
+
+`score` is (N, num_class), `label` (N,). The k highest scores of every row
+are found once with np.argpartition for the largest k asked for, and the
+per-class rates come from two np.bincount calls, so no Python loop runs
+over samples or classes.
+
+StreamingMetrics accumulates the same numbers batch by batch on the model's
+device, together with recall, precision, F1 and AUROC.
+"""
+
+import numpy as np
+import torch
+
+
+def top_k_indices(score, k):
+    # (N, k) class indices sorted by decreasing score
+    score = np.asarray(score)
+    k = min(k, score.shape[1])
+    top = np.argpartition(score, -k, axis=1)[:, -k:]
+    order = np.argsort(-np.take_along_axis(score, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def top_k_hits(score, label, ks):
+    """{k: (N,) bool}, whether the label is among the k highest scores."""
+    label = np.asarray(label)
+    top = top_k_indices(score, max(ks))
+    hit = np.cumsum(top == label[:, None], axis=1).astype(bool)
+    return {k: hit[:, min(k, hit.shape[1]) - 1] for k in ks}
+
+
+def per_class_accuracy(hit, label, num_class=None):
+    # (num_class,) hit rate of every class, nan for classes without samples
+    label = np.asarray(label)
+    num_class = num_class or label.max() + 1
+    hits = np.bincount(label, weights=hit, minlength=num_class)
+    count = np.bincount(label, minlength=num_class)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return hits / count
+
+
+def top_k_accuracy(score, label, ks=(1, 5), num_class=None):
+    """{k: (accuracy, mean per-class accuracy)} for every k in `ks`."""
+    hits = top_k_hits(score, label, ks)
+    return {
+        k: (hit.mean(), per_class_accuracy(hit, label, num_class).mean())
+        for k, hit in hits.items()
+    }
+
+
+def _safe_divide(num, denom):
+    # 0 where the denominator is 0, as torchmetrics does
+    return torch.where(denom > 0, num / denom.clamp(min=1), torch.zeros_like(num))
+
+
+class StreamingMetrics:
+    """Classification metrics updated per batch with O(num_class) state.
+
+    Keeps per-class counts of labels, predictions, top-1 hits and top-k hits,
+    i.e. the diagonal and marginals of the confusion matrix. AUROC is
+    one-vs-rest and macro averaged like torchmetrics.AUROC:
+    'binned' histograms the log-softmax score of every class into `num_bins`
+    bins over [log_min, 0] separately for positives and negatives (AUROC only
+    depends on the order of the scores, and log-probabilities spread the small
+    scores of thousands of classes over the bins), 'exact' keeps all outputs
+    in a torchmetrics.AUROC and 'off' skips it.
+    """
+
+    def __init__(
+        self,
+        num_class,
+        ks=(1, 5),
+        auroc="binned",
+        num_bins=1000,
+        log_min=-30.0,
+        device=None,
+    ):
+        if auroc not in ["binned", "exact", "off"]:
+            raise ValueError(f"Unexpected AUROC mode {auroc}")
+        self.num_class = num_class
+        self.ks = sorted(set(ks) | {1})
+        self.auroc = auroc
+        self.num_bins = num_bins
+        self.log_min = log_min
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        C, B = self.num_class, self.num_bins
+        zeros = lambda *shape: torch.zeros(shape, dtype=torch.int64, device=self.device)
+        self.label_count = zeros(C)
+        self.pred_count = zeros(C)
+        self.hits = {k: zeros(C) for k in self.ks}
+        if self.auroc == "binned":
+            self.pos_hist = zeros(C, B)
+            self.all_hist = zeros(C, B)
+        elif self.auroc == "exact":
+            import torchmetrics
+
+            self.exact_auroc = torchmetrics.AUROC(
+                task="multiclass", average="macro", num_classes=C
+            ).to(self.device)
+
+    @torch.no_grad()
+    def update(self, output, label):
+        # output: N, num_class scores, label: N
+        C, B = self.num_class, self.num_bins
+        label = label.long()
+        top = output.topk(min(max(self.ks), C), dim=1).indices
+        hit = (top == label[:, None]).cumsum(dim=1).bool()
+        self.label_count += torch.bincount(label, minlength=C)
+        self.pred_count += torch.bincount(top[:, 0], minlength=C)
+        for k in self.ks:
+            self.hits[k] += torch.bincount(
+                label, weights=hit[:, min(k, C) - 1].long(), minlength=C
+            ).long()
+
+        if self.auroc == "binned":
+            log_prob = torch.log_softmax(output.float(), dim=1)
+            bins = ((log_prob - self.log_min) * (B / -self.log_min)).long()
+            bins = bins.clamp_(0, B - 1)
+            offset = torch.arange(C, device=bins.device) * B
+            self.all_hist += torch.bincount(
+                (bins + offset).flatten(), minlength=C * B
+            ).view(C, B)
+            pos = bins.gather(1, label[:, None]).squeeze(1) + label * B
+            self.pos_hist += torch.bincount(pos, minlength=C * B).view(C, B)
+        elif self.auroc == "exact":
+            self.exact_auroc.update(output, label)
+
+    def binned_auroc(self):
+        # per class, P(score_pos > score_neg) + 1/2 P(same bin)
+        pos = self.pos_hist.double()
+        neg = (self.all_hist - self.pos_hist).double()
+        pos_below = pos.cumsum(dim=1) - pos
+        auc = (neg * (pos.sum(1, keepdim=True) - pos_below - pos / 2)).sum(1)
+        num_pairs = pos.sum(1) * neg.sum(1)
+        # classes without positives or negatives have no ROC curve
+        valid = num_pairs > 0
+        return (auc[valid] / num_pairs[valid]).mean()
+
+    def compute(self):
+        """Dict of top-k (per-class) accuracy, recall, precision, F1 and AUROC."""
+        label_count = self.label_count.double()
+        tp = self.hits[1].double()
+        recall = _safe_divide(tp, label_count)
+        precision = _safe_divide(tp, self.pred_count.double())
+        result = dict(
+            recall=recall,
+            precision=precision,
+            f1=_safe_divide(2 * recall * precision, recall + precision),
+        )
+        for k in self.ks:
+            hits = self.hits[k].double()
+            result[f"top{k}"] = (hits.sum() / label_count.sum()).item()
+            # nan for classes without samples, as per_class_accuracy
+            result[f"top{k}_per_class"] = (hits / label_count).mean().item()
+        if self.auroc == "binned":
+            result["auroc"] = self.binned_auroc().item()
+        elif self.auroc == "exact":
+            result["auroc"] = self.exact_auroc.compute().item()
+        return result
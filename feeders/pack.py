@@ -0,0 +1,143 @@
+"""Pack padded (N, C, T, V, M) datasets into a variable-length format.
+
+    python -m feeders.pack --dataset WLASL2000 --dtype float16
+
+turns ./data/WLASL2000/{split}_data_joint.npy + {split}_label.pkl into
+
+    {split}_data_joint_packed.npy        (total_frames, C, V, M) frame buffer
+    {split}_data_joint_packed_index.npz  offset, length, begin, label, sample_name
+
+Only the span between the first and the last non-null frame of every sample
+is kept, which feeders.feeder.PackedFeeder slices out by offset.
+"""
+
+import os
+import pickle
+import warnings
+
+import numpy as np
+
+from feeders import fileio
+from feeders import streams
+
+
+def packed_paths(data_path):
+    root = os.path.splitext(data_path)[0]
+    return root + "_packed.npy", root + "_packed_index.npz"
+
+
+def load_label(label_path):
+    try:
+        with open(label_path) as f:
+            sample_name, label = pickle.load(f)
+    except:
+        # for pickle file from python2
+        with open(label_path, "rb") as f:
+            sample_name, label = pickle.load(f, encoding="latin1")
+    return sample_name, label
+
+
+def valid_span(data_numpy):
+    # input: N,C,T,V,M -> first and one past the last non-null frame per sample
+    T = data_numpy.shape[2]
+    valid = ((data_numpy != 0) & ~np.isinf(data_numpy)).any(axis=(1, 3, 4))
+    begin = valid.argmax(axis=1)
+    end = T - valid[:, ::-1].argmax(axis=1)
+    # keep one (null) frame of empty samples so they can still be sampled
+    empty = ~valid.any(axis=1)
+    begin[empty] = 0
+    end[empty] = 1
+    return begin, end
+
+
+def find_spans(data_path, chunk_size=256):
+    data = np.load(data_path, mmap_mode="r")
+    spans = [valid_span(chunk) for _, chunk in fileio.iter_chunks(data, chunk_size)]
+    begin = np.concatenate([b for b, _ in spans])
+    end = np.concatenate([e for _, e in spans])
+    return begin, end
+
+
+def spans_path(data_path):
+    return os.path.splitext(data_path)[0] + "_lengths.npy"
+
+
+def load_spans(data_path, chunk_size=256):
+    """(N, 2) begin/end of the valid frames, cached in a *_lengths.npy sidecar.
+
+    The sidecar is rebuilt when it is older than the data file.
+    """
+    path = spans_path(data_path)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(data_path):
+        return np.load(path)
+    spans = np.stack(find_spans(data_path, chunk_size), axis=1)
+    try:
+        with fileio.atomic_save(path) as tmp_path:
+            np.save(tmp_path, spans)
+    except OSError as e:
+        warnings.warn("could not cache frame spans to {}: {}".format(path, e))
+    return spans
+
+
+def pack(data_path, label_path, begin, end, dtype=np.float32, chunk_size=256):
+    data = np.load(data_path, mmap_mode="r")
+    N, C, T, V, M = data.shape
+    length = end - begin
+    offset = np.concatenate([[0], np.cumsum(length)[:-1]])
+    buffer_path, index_path = packed_paths(data_path)
+
+    with fileio.atomic_save(buffer_path) as tmp_path:
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=dtype, shape=(int(length.sum()), C, V, M)
+        )
+        for start, chunk in fileio.iter_chunks(data, chunk_size):
+            for i, sample in enumerate(chunk, start):
+                out[offset[i] : offset[i] + length[i]] = sample[
+                    :, begin[i] : end[i]
+                ].transpose(1, 0, 2, 3)
+        out.flush()
+        del out
+
+    sample_name, label = load_label(label_path)
+    with fileio.atomic_save(index_path) as tmp_path:
+        np.savez(
+            tmp_path,
+            offset=offset,
+            length=length,
+            begin=begin,
+            padded_length=T,
+            label=np.asarray(label, dtype=np.int64),
+            sample_name=np.asarray(sample_name),
+        )
+    return buffer_path, index_path
+
+
+def get_parser():
+    parser = fileio.get_parser("Pack a skeleton dataset into a variable-length format")
+    parser.add_argument("--dtype", default="float32", choices=["float16", "float32"])
+    return parser
+
+
+if __name__ == "__main__":
+    arg = get_parser().parse_args()
+    for joint_path, label_path in fileio.split_paths(arg):
+        # the valid span is taken from the joints and shared by all streams
+        begin, end = load_spans(joint_path, arg.chunk_size).T
+        for name in fileio.stream_names(arg):
+            data_path = streams.stream_path(joint_path, name)
+            buffer_path, _ = pack(
+                data_path,
+                label_path,
+                begin,
+                end,
+                dtype=np.dtype(arg.dtype),
+                chunk_size=arg.chunk_size,
+            )
+            size = os.path.getsize(buffer_path)
+            print(
+                "wrote {} ({:.1f}% of {})".format(
+                    buffer_path,
+                    100 * size / os.path.getsize(data_path),
+                    os.path.basename(data_path),
+                )
+            )
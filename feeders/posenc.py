@@ -1,3 +1,5 @@
+import hashlib
+import os
 from copy import deepcopy
 
 import numpy as np
@@ -12,9 +14,17 @@ from torch_geometric.utils import (
 from torch_geometric.utils.num_nodes import maybe_num_nodes
 from torch_scatter import scatter_add
 
+from feeders import fileio
+
 
 def compute_posenc_stats(
-    data, pe_types, is_undirected, laplacian_norm_type, max_freqs, eigvec_norm
+    data,
+    pe_types,
+    is_undirected,
+    laplacian_norm_type,
+    max_freqs,
+    eigvec_norm,
+    eigen_solver="dense",
 ):
     """Precompute positional encodings for the given graph.
 
@@ -31,6 +41,8 @@ def compute_posenc_stats(
             This can also be a combination, e.g. 'eigen+rw_landing'
         is_undirected: True if the graph is expected to be undirected
         cfg: Main configuration node
+        eigen_solver: 'dense' for a full `np.linalg.eigh`, 'sparse' to only
+            compute the `max_freqs` smallest eigenpairs with `eigsh`
 
     Returns:
         Extended PyG Data object.
@@ -70,42 +82,265 @@ def compute_posenc_stats(
                 undir_edge_index, normalization=laplacian_norm_type, num_nodes=N
             )
         )
-        evals, evects = np.linalg.eigh(L.toarray())
+        if eigen_solver == "sparse" and N > max_freqs + 1:
+            evals, evects = smallest_eigenpairs(L, max_freqs)
+        else:
+            evals, evects = np.linalg.eigh(L.toarray())
 
     return get_lap_decomp_stats(
         evals=evals, evects=evects, max_freqs=max_freqs, eigvec_norm=eigvec_norm
     )
 
 
+def smallest_eigenpairs(L, k):
+    """The `k` smallest eigenpairs of a sparse PSD Laplacian.
+
+    Shift-invert Lanczos around a small negative shift, so the factorized
+    (L - sigma * I) is non-singular and the eigenvalues closest to 0 converge
+    first. With repeated eigenvalues (e.g. several connected components) any
+    orthonormal basis of the eigenspace may come back, as with `eigh`.
+    """
+    from scipy.sparse.linalg import eigsh
+
+    dtype = L.dtype
+    L = L.astype(np.float64).tocsc()
+    evals, evects = eigsh(L, k=k, sigma=-1e-3, which="LM")
+    idx = evals.argsort()
+    # in the dtype of L, as `eigh` returns them
+    return evals[idx].astype(dtype), evects[:, idx].astype(dtype)
+
+
+def lap_pe(
+    edge_index,
+    num_nodes,
+    laplacian_norm_type="none",
+    max_freqs=8,
+    eigvec_norm="L2",
+    eigen_solver="sparse",
+    cache_dir=None,
+):
+    """LapPE (EigVals, EigVecs) of an undirected graph, cached on disk.
+
+    The cache file name is a hash of everything the result depends on, so a
+    different window size, graph or setting never reuses a stale file.
+    """
+    key = hashlib.sha1(
+        np.ascontiguousarray(edge_index.cpu().numpy().astype(np.int64)).tobytes()
+    )
+    key.update(
+        repr(
+            (int(num_nodes), laplacian_norm_type, max_freqs, eigvec_norm, eigen_solver)
+        ).encode()
+    )
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, "lap_pe_{}.pt".format(key.hexdigest()[:16]))
+        if os.path.exists(path):
+            cached = torch.load(path)
+            return cached["eig_vals"], cached["eig_vecs"]
+
+    from torch_geometric.data import Data
+
+    eig_vals, eig_vecs = compute_posenc_stats(
+        Data(edge_index=edge_index, num_nodes=num_nodes),
+        ["LapPE"],
+        is_undirected=True,
+        laplacian_norm_type=laplacian_norm_type,
+        max_freqs=max_freqs,
+        eigvec_norm=eigvec_norm,
+        eigen_solver=eigen_solver,
+    )
+    if cache_dir is not None:
+        with fileio.atomic_save(path) as tmp_path:
+            torch.save({"eig_vals": eig_vals, "eig_vecs": eig_vecs}, tmp_path)
+    return eig_vals, eig_vecs
+
+
+def replicated_edge_index(spatial_edge_index, num_point, window, temporal="none"):
+    # node t * num_point + v is joint v of frame t, as in product_eigenpairs
+    edges = [spatial_edge_index + t * num_point for t in range(window)]
+    if temporal == "path":
+        src = torch.arange(num_point * (window - 1))
+        edges.append(torch.stack([src, src + num_point]))
+    return to_undirected(torch.cat(edges, dim=1))
+
+
+def product_eigenpairs(
+    spatial_edge_index,
+    num_point,
+    window,
+    temporal="none",
+    laplacian_norm_type=None,
+    max_freqs=None,
+):
+    """Laplacian eigenpairs of a skeleton graph replicated over `window` frames.
+
+    Node `t * num_point + v` is joint v of frame t. With temporal='none' the
+    frames are disconnected copies (block diagonal L = I (x) L_s); with
+    temporal='path' joint v is also linked to itself in the neighbouring
+    frames (Cartesian product, L = L_path (x) I + I (x) L_s). Either way the
+    eigenpairs are (nu_b + mu_a, phi_b (x) psi_a) from the 27x27 spatial
+    problem (mu, psi) and the path spectrum nu_b = 2 - 2 cos(pi b / W),
+    phi_b(t) = cos(pi b (t + 1/2) / W), so nothing of size N x N is formed.
+    For 'none' all nu_b are 0 and phi is used as the basis of each repeated
+    eigenspace, ordered from low to high temporal frequency.
+
+    Returns the `max_freqs` smallest (all if None) eigenvalues and vectors.
+    """
+    if laplacian_norm_type == "none":
+        laplacian_norm_type = None
+    if temporal == "path" and laplacian_norm_type is not None:
+        # degrees differ between border and inner frames, the product breaks
+        raise ValueError("the path product is only separable for norm 'none'")
+    if temporal not in ["none", "path"]:
+        raise ValueError(f"Unexpected temporal structure {temporal}")
+
+    L = to_scipy_sparse_matrix(
+        *get_laplacian(
+            to_undirected(spatial_edge_index),
+            normalization=laplacian_norm_type,
+            num_nodes=num_point,
+        ),
+        num_nodes=num_point,
+    )
+    mu, psi = np.linalg.eigh(L.toarray().astype(np.float64))
+
+    b = np.arange(window)
+    nu = 2 - 2 * np.cos(np.pi * b / window) if temporal == "path" else np.zeros(window)
+    phi = np.cos(np.pi * np.outer(np.arange(window) + 0.5, b) / window)
+    phi /= np.linalg.norm(phi, axis=0, keepdims=True)
+
+    # all window * num_point eigenvalues, ties broken by temporal frequency
+    evals = (nu[:, None] + mu[None, :]).ravel()
+    order = np.lexsort((np.repeat(b, num_point), evals))[:max_freqs]
+    tb, sa = np.divmod(order, num_point)
+    evects = (phi[:, None, tb] * psi[None, :, sa]).reshape(window * num_point, -1)
+    return evals[order], evects
+
+
+def product_lap_pe(
+    spatial_edge_index,
+    num_point,
+    window,
+    temporal="none",
+    laplacian_norm_type="none",
+    max_freqs=8,
+    eigvec_norm="L2",
+    cache_dir=None,
+):
+    """LapPE (EigVals, EigVecs) of a replicated skeleton graph in closed form.
+
+    A path-connected window with a normalized Laplacian is not separable; it
+    goes through the sparse, cached `lap_pe` on the full graph instead.
+    """
+    if temporal == "path" and laplacian_norm_type not in [None, "none"]:
+        return lap_pe(
+            replicated_edge_index(spatial_edge_index, num_point, window, temporal),
+            num_point * window,
+            laplacian_norm_type=laplacian_norm_type,
+            max_freqs=max_freqs,
+            eigvec_norm=eigvec_norm,
+            cache_dir=cache_dir,
+        )
+    evals, evects = product_eigenpairs(
+        spatial_edge_index,
+        num_point,
+        window,
+        temporal=temporal,
+        laplacian_norm_type=laplacian_norm_type,
+        max_freqs=max_freqs,
+    )
+    # float32 like the eigh of the float32 Laplacian in compute_posenc_stats
+    return get_lap_decomp_stats(
+        evals=evals.astype(np.float32),
+        evects=evects,
+        max_freqs=max_freqs,
+        eigvec_norm=eigvec_norm,
+    )
+
+
+class LapPECollate:
+    """Collate (C, T, V, M) samples into one LapPE batch.
+
+    Every sample shares the graph and its spectrum, so `edge_index`, `EigVecs`
+    and `EigVals` are attached once per batch instead of being copied into a
+    Data object per sample. Node features are (N, T*V, C*M), `pos` their first
+    two channels, and `edge_attr` the (N, E, 1) edge lengths scaled to [0, 1]
+    per sample, as torch_geometric.transforms.Distance() computes them.
+
+    The batch is a dict, not the (N, C, T, V, M) tensor that main.Processor
+    moves to the device and model.fstgan.Model consumes; it is meant for
+    external LapPE graph models with their own training loop.
+    """
+
+    def __init__(self, edge_index, eig_vecs, eig_vals, window):
+        self.edge_index = edge_index
+        self.eig_vecs = eig_vecs
+        self.eig_vals = eig_vals
+        self.window = window
+
+    def edge_distance(self, pos):
+        # pos: N, nodes, 2 -> N, E, 1
+        row, col = self.edge_index
+        dist = torch.norm(pos[:, col] - pos[:, row], p=2, dim=-1)
+        if dist.shape[1] > 0:
+            dist = dist / dist.amax(dim=1, keepdim=True)
+        return dist.unsqueeze(-1)
+
+    def __call__(self, batch):
+        data, label, index = zip(*batch)
+        data = torch.from_numpy(np.stack(data)).float()
+        N, C, T, V, M = data.shape
+        x = data.permute(0, 2, 3, 1, 4).reshape(N, T * V, C * M)
+        pos = x[:, :, :2]
+        label = torch.as_tensor(label, dtype=torch.int64)
+        return (
+            dict(
+                x=x,
+                pos=pos,
+                edge_index=self.edge_index,
+                edge_attr=self.edge_distance(pos),
+                y=label,
+                EigVecs=self.eig_vecs,
+                EigVals=self.eig_vals,
+                window=self.window,
+            ),
+            label,
+            torch.as_tensor(index),
+        )
+
+
 def get_lap_decomp_stats(evals, evects, max_freqs, eigvec_norm="L2"):
     """Compute Laplacian eigen-decomposition-based PE stats of the given graph.
 
     Args:
-        evals, evects: Precomputed eigen-decomposition
+        evals, evects: Precomputed (possibly partial) eigen-decomposition
         max_freqs: Maximum number of top smallest frequencies / eigenvecs to use
         eigvec_norm: Normalization for the eigen vectors of the Laplacian
     Returns:
         Tensor (num_nodes, max_freqs, 1) eigenvalues repeated for each node
         Tensor (num_nodes, max_freqs) of eigenvector values per node
     """
-    N = len(evals)  # Number of nodes, including disconnected nodes.
+    N = evects.shape[0]  # Number of nodes, including disconnected nodes.
 
     # Keep up to the maximum desired number of frequencies.
     idx = evals.argsort()[:max_freqs]
     evals, evects = evals[idx], np.real(evects[:, idx])
     evals = torch.from_numpy(np.real(evals)).clamp_min(0)
+    num_freqs = len(evals)
 
     # Normalize and pad eigen vectors.
     evects = torch.from_numpy(evects).float()
     evects = eigvec_normalizer(evects, evals, normalization=eigvec_norm)
-    if N < max_freqs:
-        EigVecs = F.pad(evects, (0, max_freqs - N), value=float("nan"))
+    if num_freqs < max_freqs:
+        EigVecs = F.pad(evects, (0, max_freqs - num_freqs), value=float("nan"))
     else:
         EigVecs = evects
 
     # Pad and save eigenvalues.
-    if N < max_freqs:
-        EigVals = F.pad(evals, (0, max_freqs - N), value=float("nan")).unsqueeze(0)
+    if num_freqs < max_freqs:
+        EigVals = F.pad(
+            evals, (0, max_freqs - num_freqs), value=float("nan")
+        ).unsqueeze(0)
     else:
         EigVals = evals.unsqueeze(0)
     EigVals = EigVals.repeat(N, 1).unsqueeze(2)
@@ -114,7 +349,14 @@ def get_lap_decomp_stats(evals, evects, max_freqs, eigvec_norm="L2"):
 
 
 def get_rw_landing_probs(
-    ksteps, edge_index, edge_weight=None, num_nodes=None, space_dim=0
+    ksteps,
+    edge_index,
+    edge_weight=None,
+    num_nodes=None,
+    space_dim=0,
+    method="dense",
+    num_probes=64,
+    generator=None,
 ):
     """Compute Random Walk landing probabilities for given list of K steps.
 
@@ -128,6 +370,12 @@ def get_rw_landing_probs(
             In euclidean space, this correction means that the height of
             the gaussian distribution stays almost constant across the number of
             steps, if `space_dim` is the dimension of the euclidean space.
+        method: 'dense' raises the dense (Num nodes)^2 matrix P to the power k,
+            'sparse' keeps P^k sparse (exact, memory grows with the fill-in of
+            P^k), 'hutchinson' estimates diag(P^k) as the mean of z * P^k z
+            over `num_probes` Rademacher vectors z (unbiased, O(E) memory)
+        num_probes: Number of probe vectors for 'hutchinson'
+        generator: (optional) torch.Generator drawing the 'hutchinson' probes
 
     Returns:
         2D Tensor with shape (num_nodes, len(ksteps)) with RW landing probs
@@ -140,6 +388,24 @@ def get_rw_landing_probs(
     deg_inv = deg.pow(-1.0)
     deg_inv.masked_fill_(deg_inv == float("inf"), 0)
 
+    if method == "sparse":
+        return _rw_landing_sparse(
+            ksteps, source, dest, edge_weight * deg_inv[source], num_nodes, space_dim
+        )
+    if method == "hutchinson":
+        return _rw_landing_hutchinson(
+            ksteps,
+            source,
+            dest,
+            edge_weight * deg_inv[source],
+            num_nodes,
+            space_dim,
+            num_probes,
+            generator,
+        )
+    if method != "dense":
+        raise ValueError(f"Unexpected RW landing method {method}")
+
     if edge_index.numel() == 0:
         P = edge_index.new_zeros((1, num_nodes, num_nodes))
     else:
@@ -166,6 +432,62 @@ def get_rw_landing_probs(
     return rw_landing
 
 
+def _rw_landing_sparse(ksteps, source, dest, weight, num_nodes, space_dim):
+    """Exact diag(P^k) with scipy sparse products, P = D^-1 * A."""
+    from scipy.sparse import csr_matrix, identity
+
+    P = csr_matrix(
+        (
+            weight.cpu().double().numpy(),
+            (source.cpu().numpy(), dest.cpu().numpy()),
+        ),
+        shape=(num_nodes, num_nodes),
+    )
+    rws = dict()
+    Pk = identity(num_nodes, dtype=np.float64, format="csr")
+    for k in range(1, max(ksteps) + 1):
+        if k in ksteps:
+            # diag(P^(k-1) @ P) without forming the last product
+            rws[k] = np.asarray(Pk.multiply(P.T).sum(axis=1)).ravel()
+        if k < max(ksteps):
+            Pk = Pk @ P
+    rw_landing = np.stack(
+        [
+            rws[k] * (k ** (space_dim / 2)) if k > 0 else np.ones(num_nodes)
+            for k in ksteps
+        ],
+        axis=1,
+    )
+    return torch.from_numpy(rw_landing).float().to(weight.device)
+
+
+def _rw_landing_hutchinson(
+    ksteps, source, dest, weight, num_nodes, space_dim, num_probes, generator
+):
+    """Hutchinson estimate of diag(P^k) with sparse mat-vec products only."""
+    P = torch.sparse_coo_tensor(
+        torch.stack([source, dest]), weight.float(), (num_nodes, num_nodes)
+    ).coalesce()
+    z = torch.randint(2, (num_nodes, num_probes), generator=generator).to(weight)
+    z = z.float() * 2 - 1
+    rws = {0: torch.ones(num_nodes, device=weight.device)}
+    v = z
+    for k in range(1, max(ksteps) + 1):
+        v = torch.sparse.mm(P, v)
+        if k in ksteps:
+            rws[k] = (z * v).mean(dim=1)
+    return torch.stack([rws[k] * (k ** (space_dim / 2)) for k in ksteps], dim=1)
+
+
+def _heat_kernel_factors(evects, evals):
+    """L2-normalized eigenvectors and eigenvalues without the null space."""
+    evects = F.normalize(evects, p=2.0, dim=0)
+
+    # Remove eigenvalues == 0 from the computation of the heat kernel
+    idx_remove = evals < 1e-8
+    return evects[:, ~idx_remove], evals[~idx_remove]
+
+
 def get_heat_kernels_diag(evects, evals, kernel_times=[], space_dim=0):
     """Compute Heat kernel diagonal.
 
@@ -173,6 +495,9 @@ def get_heat_kernels_diag(evects, evals, kernel_times=[], space_dim=0):
     space, and is the solution to the diffusion equation.
     The random-walk diagonal should converge to this.
 
+    The diagonal is (evects**2) @ exp(-t * evals), a (Num nodes) x (Num eigs)
+    by (Num eigs) x (Num kernel times) product, so no kernel is materialized.
+
     Args:
         evects: Eigenvectors of the Laplacian matrix
         evals: Eigenvalues of the Laplacian matrix
@@ -189,34 +514,35 @@ def get_heat_kernels_diag(evects, evals, kernel_times=[], space_dim=0):
     """
     heat_kernels_diag = []
     if len(kernel_times) > 0:
-        evects = F.normalize(evects, p=2.0, dim=0)
-
-        # Remove eigenvalues == 0 from the computation of the heat kernel
-        idx_remove = evals < 1e-8
-        evals = evals[~idx_remove]
-        evects = evects[:, ~idx_remove]
-
-        # Change the shapes for the computations
-        evals = evals.unsqueeze(-1)  # lambda_{i, ..., ...}
-        evects = evects.transpose(0, 1)  # phi_{i,j}: i-th eigvec X j-th node
-
-        # Compute the heat kernels diagonal only for each time
-        eigvec_mul = evects**2
-        for t in kernel_times:
-            # sum_{i>0}(exp(-2 t lambda_i) * phi_{i, j} * phi_{i, j})
-            this_kernel = torch.sum(
-                torch.exp(-t * evals) * eigvec_mul, dim=0, keepdim=False
-            )
+        evects, evals = _heat_kernel_factors(evects, evals)
+        times = torch.as_tensor(kernel_times, dtype=evects.dtype, device=evects.device)
+
+        # sum_{i>0}(exp(-t lambda_i) * phi_{i, j} * phi_{i, j})
+        heat_kernels_diag = (evects**2) @ torch.exp(-evals.unsqueeze(1) * times)
 
-            # Multiply by `t` to stabilize the values, since the gaussian height
-            # is proportional to `1/t`
-            heat_kernels_diag.append(this_kernel * (t ** (space_dim / 2)))
-        heat_kernels_diag = torch.stack(heat_kernels_diag, dim=0).transpose(0, 1)
+        # Multiply by `t` to stabilize the values, since the gaussian height
+        # is proportional to `1/t`
+        heat_kernels_diag = heat_kernels_diag * times ** (space_dim / 2)
 
     return heat_kernels_diag
 
 
-def get_heat_kernels(evects, evals, kernel_times=[]):
+def iter_heat_kernel_blocks(evects, evals, kernel_times=[], block_size=1024):
+    """Yield (start, block) with the heat kernel rows start:start+block_size.
+
+    Each block is (Num kernel times) x (block_size) x (Num nodes), so memory is
+    bounded by the block instead of the (Num eigs) x (Num nodes)^2 stack.
+    """
+    evects, evals = _heat_kernel_factors(evects, evals)
+    times = torch.as_tensor(kernel_times, dtype=evects.dtype, device=evects.device)
+    decay = torch.exp(-times.unsqueeze(1) * evals)  # (Num kernel times) x (Num eigs)
+    for start in range(0, evects.shape[0], block_size):
+        rows = evects[start : start + block_size]
+        # sum_{i>0}(exp(-t lambda_i) * phi_{i, j1} * phi_{i, j2})
+        yield start, (rows * decay.unsqueeze(1)) @ evects.T
+
+
+def get_heat_kernels(evects, evals, kernel_times=[], block_size=1024):
     """Compute full Heat diffusion kernels.
 
     Args:
@@ -224,38 +550,24 @@ def get_heat_kernels(evects, evals, kernel_times=[]):
         evals: Eigenvalues of the Laplacian matrix
         kernel_times: Time for the diffusion. Analogous to the k-steps in random
             walk. The time is equivalent to the variance of the kernel.
+        block_size: Number of kernel rows computed at once, see
+            `iter_heat_kernel_blocks` to consume the kernel block by block
     """
     heat_kernels, rw_landing = [], []
     if len(kernel_times) > 0:
-        evects = F.normalize(evects, p=2.0, dim=0)
-
-        # Remove eigenvalues == 0 from the computation of the heat kernel
-        idx_remove = evals < 1e-8
-        evals = evals[~idx_remove]
-        evects = evects[:, ~idx_remove]
-
-        # Change the shapes for the computations
-        evals = evals.unsqueeze(-1).unsqueeze(-1)  # lambda_{i, ..., ...}
-        evects = evects.transpose(0, 1)  # phi_{i,j}: i-th eigvec X j-th node
-
-        # Compute the heat kernels for each time
-        eigvec_mul = evects.unsqueeze(2) * evects.unsqueeze(
-            1
-        )  # (phi_{i, j1, ...} * phi_{i, ..., j2})
-        for t in kernel_times:
-            # sum_{i>0}(exp(-2 t lambda_i) * phi_{i, j1, ...} * phi_{i, ..., j2})
-            heat_kernels.append(
-                torch.sum(torch.exp(-t * evals) * eigvec_mul, dim=0, keepdim=False)
-            )
-
-        heat_kernels = torch.stack(
-            heat_kernels, dim=0
+        N = evects.shape[0]
+        heat_kernels = evects.new_empty(
+            (len(kernel_times), N, N)
         )  # (Num kernel times) x (Num nodes) x (Num nodes)
+        for start, block in iter_heat_kernel_blocks(
+            evects, evals, kernel_times, block_size
+        ):
+            heat_kernels[:, start : start + block.shape[1]] = block
 
-        # Take the diagonal of each heat kernel,
+        # The diagonal of each heat kernel,
         # i.e. the landing probability of each of the random walks
-        rw_landing = torch.diagonal(heat_kernels, dim1=-2, dim2=-1).transpose(
-            0, 1
+        rw_landing = get_heat_kernels_diag(
+            evects, evals, kernel_times
         )  # (Num nodes) x (Num kernel times)
 
     return heat_kernels, rw_landing
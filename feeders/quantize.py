@@ -0,0 +1,105 @@
+"""Reduced-precision copies of the skeleton arrays.
+
+    python -m feeders.quantize --dataset WLASL2000 --dtype int16
+
+writes {split}_data_joint_int16.npy (+ a per-channel {..}_int16_scale.npy)
+next to the original and reports the max reconstruction error per channel.
+The Feeder reads it with `storage: int16` and dequantizes every sample
+lazily. float16 needs no scale and is written the same way.
+"""
+
+import os
+
+import numpy as np
+
+from feeders import fileio
+from feeders import streams
+
+INT16_MAX = np.iinfo(np.int16).max
+
+
+def quantized_paths(data_path, dtype):
+    root = os.path.splitext(data_path)[0]
+    return root + "_{}.npy".format(dtype), root + "_{}_scale.npy".format(dtype)
+
+
+def load_scale(data_path, dtype):
+    if dtype != "int16":
+        return None
+    return np.load(quantized_paths(data_path, dtype)[1])
+
+
+def dequantize(data_numpy, scale=None):
+    # input: C,T,V,M or N,C,T,V,M, scale is per channel
+    data_numpy = np.asarray(data_numpy, dtype=np.float32)
+    if scale is not None:
+        data_numpy = data_numpy * scale.reshape(-1, 1, 1, 1)
+    return data_numpy
+
+
+def channel_scale(data_path, chunk_size=256):
+    # symmetric fixed point: the largest finite |value| of a channel maps to INT16_MAX
+    data = np.load(data_path, mmap_mode="r")
+    peak = np.zeros(data.shape[1])
+    for _, chunk in fileio.iter_chunks(data, chunk_size, dtype=np.float64):
+        peak = np.maximum(peak, np.abs(chunk).max(axis=(0, 2, 3, 4)))
+    peak[peak == 0] = 1
+    return (peak / INT16_MAX).astype(np.float32)
+
+
+def quantize(data_path, dtype="int16", chunk_size=256):
+    data = np.load(data_path, mmap_mode="r")
+    out_path, scale_path = quantized_paths(data_path, dtype)
+    scale = channel_scale(data_path, chunk_size) if dtype == "int16" else None
+
+    with fileio.atomic_save(out_path) as tmp_path:
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.dtype(dtype), shape=data.shape
+        )
+        for start, chunk in fileio.iter_chunks(data, chunk_size, dtype=np.float64):
+            if scale is not None:
+                chunk = np.round(chunk / scale.reshape(-1, 1, 1, 1))
+            out[start : start + len(chunk)] = chunk
+        out.flush()
+        del out
+        if scale is not None:
+            with fileio.atomic_save(scale_path) as tmp_scale_path:
+                np.save(tmp_scale_path, scale)
+    return out_path
+
+
+def reconstruction_error(data_path, dtype="int16", chunk_size=256):
+    """Max absolute error per channel between the original and the stored copy."""
+    data = np.load(data_path, mmap_mode="r")
+    stored = np.load(quantized_paths(data_path, dtype)[0], mmap_mode="r")
+    scale = load_scale(data_path, dtype)
+    error = np.zeros(data.shape[1])
+    for start, chunk in fileio.iter_chunks(data, chunk_size, dtype=np.float64):
+        restored = dequantize(stored[start : start + chunk_size], scale)
+        error = np.maximum(error, np.abs(chunk - restored).max(axis=(0, 2, 3, 4)))
+    return error
+
+
+def get_parser():
+    parser = fileio.get_parser(
+        "Store a skeleton dataset in float16 or int16 fixed point"
+    )
+    parser.add_argument("--dtype", default="int16", choices=["float16", "int16"])
+    return parser
+
+
+if __name__ == "__main__":
+    arg = get_parser().parse_args()
+    for joint_path, _ in fileio.split_paths(arg):
+        for name in fileio.stream_names(arg):
+            data_path = streams.stream_path(joint_path, name)
+            out_path = quantize(data_path, arg.dtype, arg.chunk_size)
+            error = reconstruction_error(data_path, arg.dtype, arg.chunk_size)
+            print(
+                "wrote {} ({:.1f}% of the original size)".format(
+                    out_path,
+                    100 * os.path.getsize(out_path) / os.path.getsize(data_path),
+                )
+            )
+            for c, e in enumerate(error):
+                print("\tchannel {}: max abs error {:.6g}".format(c, e))
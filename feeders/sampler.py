@@ -0,0 +1,79 @@
+import numpy as np
+from torch.utils.data import get_worker_info
+
+from feeders.tools import uniform_indices
+
+
+class TemporalSampler:
+    """Pick `size` frame indices out of a clip of T frames.
+
+    `uniform` matches tools.uniform_sample_np and shares its cached table.
+    `random` draws from the same distribution as tools.random_sample_np,
+    i.e. `size` sorted draws without replacement from every frame repeated
+    ceil(size / T) times, but with a np.random.Generator and without
+    building the repeated list.
+
+    In DataLoader workers a generator is derived from `seed` and the worker
+    seed torch hands out, so workers (and epochs) draw different frames
+    while a seeded run stays reproducible.
+    """
+
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.rng = (
+            seed
+            if isinstance(seed, np.random.Generator)
+            else np.random.default_rng(seed)
+        )
+        self.entropy = int(self.rng.integers(2**32))
+        self.worker_seed = None
+        self.worker_rng = None
+
+    def generator(self):
+        info = get_worker_info()
+        if info is None:
+            return self.rng
+        if self.worker_seed != info.seed:
+            self.worker_seed = info.seed
+            self.worker_rng = np.random.default_rng([self.entropy, info.seed])
+        return self.worker_rng
+
+    def uniform(self, T):
+        if T == self.size:
+            return np.arange(T)
+        return uniform_indices(T, self.size)
+
+    def random(self, T):
+        if T == self.size:
+            return np.arange(T)
+        interval = int(np.ceil(self.size / T))
+        counts = self.generator().multivariate_hypergeometric(
+            np.full(T, interval), self.size
+        )
+        return np.repeat(np.arange(T), counts)
+
+    def uniform_batch(self, lengths):
+        # lengths: (N,) -> (N, size)
+        lengths = np.asarray(lengths)
+        return (np.arange(self.size)[None] * (lengths / self.size)[:, None]).astype(int)
+
+    def random_batch(self, lengths):
+        # lengths: (N,) -> (N, size), a random subset of the repeated frames per row
+        lengths = np.asarray(lengths)
+        interval = np.ceil(self.size / lengths).astype(int)
+        slots = lengths * interval
+        keys = self.generator().random((len(lengths), slots.max()))
+        keys[np.arange(slots.max())[None] >= slots[:, None]] = np.inf
+        chosen = np.argpartition(keys, self.size - 1, axis=1)[:, : self.size]
+        indices = np.sort(chosen // interval[:, None], axis=1)
+        # full-length clips are passed through untouched, as in the single path
+        indices[lengths == self.size] = np.arange(self.size)
+        return indices
+
+    def __call__(self, data_numpy, random=False):
+        # input: C,T,V,M
+        T = data_numpy.shape[1]
+        if T == self.size:
+            return data_numpy
+        indices = self.random(T) if random else self.uniform(T)
+        return data_numpy[:, indices]
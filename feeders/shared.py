@@ -0,0 +1,122 @@
+"""Share loaded datasets between DataLoader workers and concurrent runs.
+
+The first process that asks for a .npy file copies it into a POSIX shared
+memory segment named after the file path, size and mtime; every other
+process (another stream trained in parallel, spawned workers) maps the same
+segment without copying. The segment header holds a ready flag and the pids
+of the attached processes, the last one to release it unlinks it. Pids of
+processes that died without releasing are pruned on every attach/release.
+"""
+
+import atexit
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+HEADER_SIZE = 4096  # int64 slots: [ready, pid, pid, ...]
+MAX_USERS = HEADER_SIZE // 8 - 1
+
+
+def segment_name(data_path):
+    st = os.stat(data_path)
+    key = "{}:{}:{}".format(os.path.abspath(data_path), st.st_size, st.st_mtime_ns)
+    return "dsta_" + hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+@contextmanager
+def _locked(name):
+    with open(os.path.join(tempfile.gettempdir(), name + ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _users(shm):
+    header = np.ndarray((MAX_USERS + 1,), dtype=np.int64, buffer=shm.buf)
+    users = header[1:]
+    for i in np.nonzero(users)[0]:
+        if not _alive(users[i]):
+            users[i] = 0
+    return header, users
+
+
+class SharedArrayCache:
+    def __init__(self, chunk_size=256):
+        self.chunk_size = chunk_size
+        self.segments = dict()  # name -> (SharedMemory, array)
+        atexit.register(self.release_all)
+
+    def get(self, data_path):
+        """Read-only array of `data_path` backed by shared memory."""
+        name = segment_name(data_path)
+        if name in self.segments:
+            return self.segments[name][1]
+
+        data = np.load(data_path, mmap_mode="r")
+        with _locked(name):
+            try:
+                shm = SharedMemory(name=name)
+            except FileNotFoundError:
+                shm = SharedMemory(
+                    name=name, create=True, size=HEADER_SIZE + max(data.nbytes, 1)
+                )
+            # the segment must outlive this process if other runs use it
+            resource_tracker.unregister(shm._name, "shared_memory")
+
+            header, users = _users(shm)
+            array = np.ndarray(
+                data.shape, dtype=data.dtype, buffer=shm.buf, offset=HEADER_SIZE
+            )
+            if not header[0]:
+                for i in range(0, len(data), self.chunk_size):
+                    array[i : i + self.chunk_size] = data[i : i + self.chunk_size]
+                header[0] = 1
+            free = np.nonzero(users == 0)[0]
+            if len(free) == 0:
+                raise RuntimeError("too many processes attached to " + data_path)
+            users[free[0]] = os.getpid()
+
+        array.flags.writeable = False
+        self.segments[name] = (shm, array)
+        return array
+
+    def release(self, name):
+        shm, _ = self.segments.pop(name)
+        with _locked(name):
+            header, users = _users(shm)
+            users[users == os.getpid()] = 0
+            last = not users.any()
+            del header, users
+            if last:
+                # unlink() unregisters from the resource tracker again
+                resource_tracker.register(shm._name, "shared_memory")
+                shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # arrays handed out are still referenced; the mapping goes with the process
+            pass
+
+    def release_all(self):
+        for name in list(self.segments):
+            self.release(name)
+
+
+cache = SharedArrayCache()
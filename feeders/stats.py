@@ -0,0 +1,86 @@
+import os
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+
+from feeders import fileio
+
+
+def stats_path(data_path):
+    return os.path.splitext(data_path)[0] + ".stats.npz"
+
+
+def chunk_moments(data_path, start, end):
+    # input: N,C,T,V,M (or packed frames T,C,V,M)
+    # -> per (C, V) count, mean and sum of squared deviations
+    chunk = np.asarray(np.load(data_path, mmap_mode="r")[start:end], dtype=np.float64)
+    if chunk.ndim == 4:
+        chunk = chunk[:, :, None]
+    count = chunk.shape[0] * chunk.shape[2] * chunk.shape[4]
+    mean = chunk.sum(axis=(0, 2, 4)) / count
+    m2 = ((chunk - mean[None, :, None, :, None]) ** 2).sum(axis=(0, 2, 4))
+    return count, mean, m2
+
+
+def merge_moments(a, b):
+    # Chan et al. parallel update of Welford's running moments
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta**2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def mean_std(data_path, num_samples=None, chunk_size=64, num_workers=0, cache=True):
+    """Per-joint mean and std of a (N, C, T, V, M) .npy file.
+
+    Packed (frames, C, V, M) buffers from feeders.pack are accepted as well,
+    `num_samples` then counts frames.
+
+    The file is walked through mmap in chunks of `chunk_size` samples, so
+    peak memory stays at one chunk per worker regardless of N. The result is
+    cached next to the data and reused while the file size and mtime match.
+
+    Returns mean_map, std_map of shape (C, 1, V, 1)
+    """
+    data = np.load(data_path, mmap_mode="r")
+    if data.ndim == 4:
+        N, C, V, M = data.shape
+    else:
+        N, C, T, V, M = data.shape
+    if num_samples is not None:
+        N = min(N, num_samples)
+    st = os.stat(data_path)
+    key = np.array([st.st_size, st.st_mtime_ns, N], dtype=np.int64)
+
+    cache_path = stats_path(data_path)
+    if cache and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if np.array_equal(cached["key"], key):
+            return cached["mean_map"], cached["std_map"]
+
+    ranges = [(data_path, i, min(i + chunk_size, N)) for i in range(0, N, chunk_size)]
+    if num_workers > 0:
+        with Pool(num_workers) as pool:
+            moments = pool.starmap(chunk_moments, ranges)
+    else:
+        moments = [chunk_moments(*r) for r in ranges]
+
+    count, mean, m2 = moments[0]
+    for m in moments[1:]:
+        count, mean, m2 = merge_moments((count, mean, m2), m)
+    dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.float32
+    mean_map = mean.reshape((C, 1, V, 1)).astype(dtype)
+    std_map = np.sqrt(m2 / count).reshape((C, 1, V, 1)).astype(dtype)
+
+    if cache:
+        # concurrent runs may share the data file, so write then rename
+        try:
+            with fileio.atomic_save(cache_path) as tmp_path:
+                np.savez(tmp_path, key=key, mean_map=mean_map, std_map=std_map)
+        except OSError as e:
+            warnings.warn("could not cache statistics to {}: {}".format(cache_path, e))
+    return mean_map, std_map
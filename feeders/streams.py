@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+from graph.sign_27 import Graph
+
+
+def bone_levels(inward):
+    """Group (parent, child) bone pairs into levels of one subtraction each.
+
+    The bone stream has always been computed in place, edge by edge in the
+    order of `inward`, so a child whose parent was already visited subtracts
+    the parent's *bone* rather than its joint. Each level below only reads
+    values that are final at that point, which keeps the vectorized result
+    bit-for-bit identical to the sequential loop.
+    """
+    order = {child: i for i, (_, child) in enumerate(inward)}
+    level = {}
+    for i, (parent, child) in enumerate(inward):
+        if parent in order and order[parent] < i:
+            level[child] = level[parent] + 1
+        else:
+            level[child] = 0
+    for i, (parent, child) in enumerate(inward):
+        if parent in order and order[parent] > i and level[parent] <= level[child]:
+            raise ValueError(
+                "bone order of edge {} can not be vectorized".format((parent, child))
+            )
+
+    levels = []
+    for k in range(max(level.values()) + 1):
+        pairs = [(p, c) for p, c in inward if level[c] == k]
+        levels.append(
+            (np.array([p for p, _ in pairs]), np.array([c for _, c in pairs]))
+        )
+    return levels
+
+
+BONE_LEVELS = bone_levels(Graph().inward)
+
+
+def bone(data_numpy, levels=BONE_LEVELS):
+    # input: C,T,V,M or N,C,T,V,M, modified in place
+    for parent, child in levels:
+        data_numpy[..., child, :] = (
+            data_numpy[..., child, :] - data_numpy[..., parent, :]
+        )
+    return data_numpy
+
+
+def motion(data_numpy):
+    # input: C,T,V,M or N,C,T,V,M, modified in place
+    data_numpy[..., :-1, :, :] = data_numpy[..., 1:, :, :] - data_numpy[..., :-1, :, :]
+    data_numpy[..., -1, :, :] = 0
+    return data_numpy
+
+
+def derive(data_numpy, bone_stream=False, motion_stream=False):
+    if bone_stream:
+        data_numpy = bone(data_numpy)
+    if motion_stream:
+        data_numpy = motion(data_numpy)
+    return data_numpy
+
+
+# stream name -> (bone_stream, motion_stream)
+STREAMS = {
+    "joint": (False, False),
+    "bone": (True, False),
+    "motion": (False, True),
+    "bone_motion": (True, True),
+}
+
+
+def stream_name(bone_stream=False, motion_stream=False):
+    for name, flags in STREAMS.items():
+        if flags == (bool(bone_stream), bool(motion_stream)):
+            return name
+
+
+def stream_path(data_path, name):
+    # ./data/WLASL2000/train_data_joint.npy -> ./data/WLASL2000/train_data_bone.npy
+    root, ext = os.path.splitext(data_path)
+    if not root.endswith("_joint"):
+        raise ValueError("expected a *_joint data file, got {}".format(data_path))
+    return root[: -len("joint")] + name + ext
@@ -1,5 +1,6 @@
 import random
 import math
+from functools import lru_cache
 import numpy as np
 
 
@@ -116,13 +117,18 @@ def random_sample_np(data_numpy, size):
     random_list = sorted(random.sample(list(range(T))*interval, size))
     return data_numpy[:, random_list]
 
+@lru_cache(maxsize=1024)
+def uniform_indices(T, size):
+    # int(i * T / size) for i in range(size), read-only since it is shared
+    uniform_list = (np.arange(size) * (T / size)).astype(int)
+    uniform_list.flags.writeable = False
+    return uniform_list
+
 def uniform_sample_np(data_numpy, size):
     C, T, V, M = data_numpy.shape
     if T == size:
         return data_numpy
-    interval = T / size
-    uniform_list = [int(i * interval) for i in range(size)]
-    return data_numpy[:, uniform_list]
+    return data_numpy[:, uniform_indices(T, size)]
 
 def random_choose_simple(data_numpy, size, center=False):
     # input: C,T,V,M 随机选择其中一段，不是很合理。因为有0
@@ -140,13 +146,12 @@ def random_choose_simple(data_numpy, size, center=False):
             begin = random.randint(0, T - size)
         return data_numpy[:, begin:begin + size, :, :]
           
-def random_move(data_numpy,
-                angle_candidate=[-10., -5., 0., 5., 10.],
-                scale_candidate=[0.9, 1.0, 1.1],
-                transform_candidate=[-0.2, -0.1, 0.0, 0.1, 0.2],
-                move_time_candidate=[1]):
-    # input: C,T,V,M
-    C, T, V, M = data_numpy.shape
+def _move_params(T,
+                 angle_candidate=[-10., -5., 0., 5., 10.],
+                 scale_candidate=[0.9, 1.0, 1.1],
+                 transform_candidate=[-0.2, -0.1, 0.0, 0.1, 0.2],
+                 move_time_candidate=[1]):
+    # per-frame rotation * scale (2,2,T) and translation (2,T) of random_move
     move_time = random.choice(move_time_candidate)
     node = np.arange(0, T, T * 1.0 / move_time).round().astype(int)
     node = np.append(node, T)
@@ -157,33 +162,50 @@ def random_move(data_numpy,
     T_x = np.random.choice(transform_candidate, num_node)
     T_y = np.random.choice(transform_candidate, num_node)
 
-    a = np.zeros(T)
-    s = np.zeros(T)
-    t_x = np.zeros(T)
-    t_y = np.zeros(T)
-
-    # linspace
+    # segment i runs linearly from node i to node i + 1 over frames
+    # node[i] .. node[i + 1] - 1, so it ends on the next key value
+    xp, key = [], []
     for i in range(num_node - 1):
-        a[node[i]:node[i + 1]] = np.linspace(
-            A[i], A[i + 1], node[i + 1] - node[i]) * np.pi / 180
-        s[node[i]:node[i + 1]] = np.linspace(S[i], S[i + 1],
-                                             node[i + 1] - node[i])
-        t_x[node[i]:node[i + 1]] = np.linspace(T_x[i], T_x[i + 1],
-                                               node[i + 1] - node[i])
-        t_y[node[i]:node[i + 1]] = np.linspace(T_y[i], T_y[i + 1],
-                                               node[i + 1] - node[i])
+        length = node[i + 1] - node[i]
+        if length > 0:
+            xp.append(node[i])
+            key.append(i)
+        if length > 1:
+            xp.append(node[i + 1] - 1)
+            key.append(i + 1)
+    pos = np.interp(np.arange(T), xp, np.arange(len(xp)))
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, len(xp) - 1)
+    w = pos - lo
+    key = np.array(key)
+    values = np.stack([A * np.pi / 180, S, T_x, T_y])
+    a, s, t_x, t_y = values[:, key[lo]] * (1 - w) + values[:, key[hi]] * w
 
     theta = np.array([[np.cos(a) * s, -np.sin(a) * s],
                       [np.sin(a) * s, np.cos(a) * s]])  # xuanzhuan juzhen
+    return theta, np.stack([t_x, t_y])
+
+
+def random_move(data_numpy, **kwargs):
+    # input: C,T,V,M
+    C, T, V, M = data_numpy.shape
+    theta, trans = _move_params(T, **kwargs)
+
+    # perform transformation, all frames at once
+    new_xy = np.einsum('ijt,jtvm->itvm', theta, data_numpy[0:2])
+    data_numpy[0:2] = new_xy + trans[:, :, None, None]  # pingyi bianhuan
+    return data_numpy
+
 
-    # perform transformation
-    for i_frame in range(T):
-        xy = data_numpy[0:2, i_frame, :, :]
-        new_xy = np.dot(theta[:, :, i_frame], xy.reshape(2, -1))
-        new_xy[0] += t_x[i_frame]
-        new_xy[1] += t_y[i_frame]  # pingyi bianhuan
-        data_numpy[0:2, i_frame, :, :] = new_xy.reshape(2, V, M)
+def random_move_batch(data_numpy, **kwargs):
+    # input: N,C,T,V,M, independent random_move per sample
+    N, C, T, V, M = data_numpy.shape
+    params = [_move_params(T, **kwargs) for _ in range(N)]
+    theta = np.stack([p[0] for p in params])
+    trans = np.stack([p[1] for p in params])
 
+    new_xy = np.einsum('nijt,njtvm->nitvm', theta, data_numpy[:, 0:2])
+    data_numpy[:, 0:2] = new_xy + trans[:, :, :, None, None]
     return data_numpy
 
 
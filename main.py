@@ -22,11 +22,13 @@ import torch.backends.cudnn as cudnn
 import torch.nn.functional as F
 from thop import profile
 import wandb
-import torchmetrics
+
+from feeders import metrics
 
 
 def init_seed(_):
-    torch.cuda.manual_seed_all(1)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(1)
     torch.manual_seed(1)
     np.random.seed(1)
     random.seed(1)
@@ -100,6 +102,42 @@ def get_parser():
         help="which Top K accuracy will be shown",
     )
 
+    parser.add_argument(
+        "--fuse-bn",
+        type=str2bool,
+        default=True,
+        help="fold the BatchNorms into the preceding layers in the test phase",
+    )
+    parser.add_argument(
+        "--amp",
+        default="off",
+        choices=["off", "fp16", "bf16"],
+        help="mixed precision of training and eval, fp16 with loss scaling",
+    )
+    parser.add_argument(
+        "--compile",
+        type=str2bool,
+        default=False,
+        help="wrap the model in torch.compile",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        default="./work_dir/compile_cache",
+        help="where compiled kernels are cached across runs",
+    )
+    parser.add_argument(
+        "--auroc",
+        default="binned",
+        choices=["binned", "exact", "off"],
+        help="binned: histogram AUROC with bounded memory, exact: keep all outputs",
+    )
+    parser.add_argument(
+        "--auroc-bins",
+        type=int,
+        default=1000,
+        help="number of score bins of the binned AUROC",
+    )
+
     # feeder
     parser.add_argument(
         "--feeder", default="feeder.feeder", help="data loader will be used"
@@ -150,10 +188,10 @@ def get_parser():
     )
     parser.add_argument(
         "--device",
-        type=int,
+        type=device_type,
         default=0,
         nargs="+",
-        help="the indexes of GPUs for training or testing",
+        help="the indexes of GPUs for training or testing, or cpu",
     )
     parser.add_argument("--optimizer", default="SGD", help="type of optimizer")
     parser.add_argument(
@@ -254,34 +292,45 @@ class Processor:
     def load_data(self):
         Feeder = import_class(self.arg.feeder)
         self.data_loader = dict()
+        self.batch_augment = dict()
         if self.arg.phase == "train":
+            dataset = Feeder(
+                **self.arg.train_feeder_args,
+                num_class=self.arg.model_args["num_class"],
+            )
             self.data_loader["train"] = torch.utils.data.DataLoader(
-                dataset=Feeder(
-                    **self.arg.train_feeder_args,
-                    num_class=self.arg.model_args["num_class"],
-                ),
+                dataset=dataset,
                 batch_size=self.arg.batch_size,
                 shuffle=True,
                 num_workers=self.arg.num_worker * len(self.arg.device),
                 drop_last=True,
                 worker_init_fn=init_seed,
+                collate_fn=getattr(dataset, "collate_fn", None),
             )
+        dataset = Feeder(
+            **self.arg.test_feeder_args, num_class=self.arg.model_args["num_class"]
+        )
         self.data_loader["test"] = torch.utils.data.DataLoader(
-            dataset=Feeder(
-                **self.arg.test_feeder_args, num_class=self.arg.model_args["num_class"]
-            ),
+            dataset=dataset,
             batch_size=self.arg.test_batch_size,
             shuffle=False,
             num_workers=self.arg.num_worker * len(self.arg.device),
             drop_last=False,
             worker_init_fn=init_seed,
+            collate_fn=getattr(dataset, "collate_fn", None),
         )
+        for ln, loader in self.data_loader.items():
+            if getattr(loader.dataset, "batch_augment", False):
+                from feeders.batch_augment import BatchAugment
+
+                self.batch_augment[ln] = BatchAugment.from_feeder(loader.dataset)
 
     def load_model(self):
         output_device = (
             self.arg.device[0] if type(self.arg.device) is list else self.arg.device
         )
         self.output_device = output_device
+        self.inference_model = None
         Model = import_class(self.arg.model)
         shutil.copy2(inspect.getfile(Model), self.arg.work_dir)
         self.model = Model(**self.arg.model_args).to(output_device)
@@ -295,9 +344,11 @@ class Processor:
                 with open(self.arg.weights, "r") as f:
                     weights = pickle.load(f)
             else:
-                ckpt = torch.load(self.arg.weights, weights_only=False)
+                ckpt = torch.load(
+                    self.arg.weights, map_location="cpu", weights_only=False
+                )
                 if "weights" in ckpt.keys():
-                    weights = torch.load(self.arg.weights, weights_only=False)["weights"]
+                    weights = ckpt["weights"]
                 else:
                     weights = ckpt
 
@@ -338,7 +389,7 @@ class Processor:
                 self.test_epoch = 200
 
         if type(self.arg.device) is list:
-            if len(self.arg.device) > 1:
+            if len(self.arg.device) > 1 and output_device != "cpu":
                 self.model = nn.DataParallel(
                     self.model, device_ids=self.arg.device, output_device=output_device
                 )
@@ -375,11 +426,34 @@ class Processor:
         else:
             raise ValueError()
 
+        # fp16 needs loss scaling, bf16 has the range of fp32
+        self.amp_device = torch.device(self.output_device).type
+        self.amp_dtype = dict(fp16=torch.float16, bf16=torch.bfloat16).get(self.arg.amp)
+        self.scaler = torch.amp.GradScaler(
+            self.amp_device, enabled=self.arg.amp == "fp16"
+        )
+
         if self.arg.weights:
-            ckpt = torch.load(self.arg.weights, weights_only=False)
+            ckpt = torch.load(self.arg.weights, map_location="cpu", weights_only=False)
             if "optimizer" in ckpt.keys():
                 opt_state_dict = ckpt["optimizer"]
-                self.optimizer.load_state_dict(opt_state_dict)
+                weights = ckpt.get("weights", {})
+                try:
+                    # checkpoints from before the MSTCN branches were fused
+                    if any(".branches." in k for k in weights.keys()):
+                        from model.fstgan import fuse_branch_optimizer_state
+
+                        opt_state_dict = fuse_branch_optimizer_state(
+                            self.model, opt_state_dict, weights
+                        )
+                    self.optimizer.load_state_dict(opt_state_dict)
+                except (KeyError, ValueError) as e:
+                    self.print_log(
+                        "Can not load the optimizer state, starting it afresh: "
+                        "{}".format(e)
+                    )
+            if ckpt.get("scaler") and self.scaler.is_enabled():
+                self.scaler.load_state_dict(ckpt["scaler"])
 
         self.lr_scheduler = ReduceLROnPlateau(
             self.optimizer,
@@ -433,6 +507,22 @@ class Processor:
         self.cur_time = time.time()
         return self.cur_time
 
+    def compile_model(self, model):
+        # in place, so the state dict keys do not change
+        if isinstance(model, nn.DataParallel):
+            self.print_log("--compile is not supported with several devices")
+            return
+        # inductor reads the cache directory at the first compilation
+        os.environ.setdefault(
+            "TORCHINDUCTOR_CACHE_DIR", os.path.abspath(self.arg.compile_cache_dir)
+        )
+        model.compile()
+
+    def autocast(self):
+        return torch.autocast(
+            self.amp_device, dtype=self.amp_dtype, enabled=self.amp_dtype is not None
+        )
+
     def split_time(self):
         split_time = time.time() - self.cur_time
         self.record_time()
@@ -464,6 +554,8 @@ class Processor:
             # get data
             data = data.float().to(self.output_device)
             label = label.long().to(self.output_device)
+            if "train" in self.batch_augment:
+                data = self.batch_augment["train"](data)
             timer["dataloader"] += self.split_time()
 
             # forward
@@ -471,18 +563,20 @@ class Processor:
                 keep_prob = -(1 - self.arg.keep_rate) / 100 * epoch + 1.0
             else:
                 keep_prob = self.arg.keep_rate
-            output = self.model(data, keep_prob)
+            with self.autocast():
+                output = self.model(data, keep_prob)
 
-            if isinstance(output, tuple):
-                output, l1 = output
-                l1 = l1.mean()
-            else:
-                l1 = 0
-            loss = self.loss(output, label) + l1
+                if isinstance(output, tuple):
+                    output, l1 = output
+                    l1 = l1.mean()
+                else:
+                    l1 = 0
+                loss = self.loss(output.float(), label) + l1
 
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
             loss_value.append(loss.data)
             timer["model"] += self.split_time()
 
@@ -519,6 +613,7 @@ class Processor:
             save_dict = {
                 "weights": weights,
                 "optimizer": self.optimizer.state_dict(),
+                "scaler": self.scaler.state_dict(),
                 "lr": self.lr,
                 "best_acc": self.best_acc,
                 "best_acc_5": self.best_acc_5,
@@ -543,6 +638,8 @@ class Processor:
         if result_file is not None:
             f_r = open(result_file, "w")
         self.model.eval()
+        # the BatchNorm-folded copy of the test phase, if any
+        model = self.model if self.inference_model is None else self.inference_model
         with torch.no_grad():
             self.print_log("Eval epoch: {}".format(epoch + 1))
             for ln in loader_name:
@@ -553,45 +650,34 @@ class Processor:
                 loss_total = 0
                 step = 0
                 process = tqdm(self.data_loader[ln])
-                test_acc = torchmetrics.Accuracy(
-                    task="multiclass",
-                    num_classes=self.arg.model_args["num_class"],
-                ).to(self.output_device)
-                test_recall = torchmetrics.Recall(
-                    task="multiclass",
-                    average="none",
-                    num_classes=self.arg.model_args["num_class"],
-                ).to(self.output_device)
-                test_precision = torchmetrics.Precision(
-                    task="multiclass",
-                    average="none",
-                    num_classes=self.arg.model_args["num_class"],
-                ).to(self.output_device)
-                test_auc = torchmetrics.AUROC(
-                    task="multiclass",
-                    average="macro",
-                    num_classes=self.arg.model_args["num_class"],
-                ).to(self.output_device)
+                # one accumulator for accuracy, recall, precision and AUROC
+                eval_metrics = metrics.StreamingMetrics(
+                    self.arg.model_args["num_class"],
+                    ks=[1, 5, *self.arg.show_topk],
+                    auroc=self.arg.auroc,
+                    num_bins=self.arg.auroc_bins,
+                    device=self.output_device,
+                )
 
                 for batch_idx, (data, label, index) in enumerate(process):
                     data = data.float().to(self.output_device)
                     label = label.long().to(self.output_device)
+                    if ln in self.batch_augment:
+                        data = self.batch_augment[ln](data)
 
-                    with torch.no_grad():
-                        output = self.model(data)
+                    with torch.no_grad(), self.autocast():
+                        output = model(data)
 
                     if isinstance(output, tuple):
                         output, l1 = output
                         l1 = l1.mean()
                     else:
                         l1 = 0
+                    output = output.float()
                     loss = self.loss(output, label)
                     score_frag.append(output.data.cpu().numpy())
                     loss_value.append(loss.data.cpu().numpy())
-                    test_acc(output.argmax(1), label)
-                    test_auc.update(output, label)
-                    test_recall(output.argmax(1), label)
-                    test_precision(output.argmax(1), label)
+                    eval_metrics.update(output, label)
 
                     _, predict_label = torch.max(output.data, 1)
                     step += 1
@@ -612,22 +698,15 @@ class Processor:
                                     + "\n"
                                 )
                 score = np.concatenate(score_frag)
-                total_acc = test_acc.compute()
-                total_recall = test_recall.compute()
-                total_precision = test_precision.compute()
-                total_auc = test_auc.compute()
+                result = eval_metrics.compute()
 
                 if "UCLA" in self.arg.Experiment_name:
                     self.data_loader[ln].dataset.sample_name = np.arange(len(score))
 
-                accuracy = self.data_loader[ln].dataset.top_k(score, 1)
-                accuracy_5 = self.data_loader[ln].dataset.top_k(score, 5)
-                accuracy_per_class = self.data_loader[ln].dataset.per_class_acc_top_k(
-                    score, 1
-                )
-                accuracy_5_per_class = self.data_loader[ln].dataset.per_class_acc_top_k(
-                    score, 5
-                )
+                accuracy = result["top1"]
+                accuracy_5 = result["top5"]
+                accuracy_per_class = result["top1_per_class"]
+                accuracy_5_per_class = result["top5_per_class"]
                 if accuracy > self.best_acc:
                     self.best_acc = accuracy
                     self.best_acc_5 = accuracy_5
@@ -657,6 +736,7 @@ class Processor:
                     save_dict = {
                         "weights": weights,
                         "optimizer": self.optimizer.state_dict(),
+                        "scaler": self.scaler.state_dict(),
                         "lr": self.lr,
                         "best_acc": self.best_acc,
                         "best_acc_5": self.best_acc_5,
@@ -671,13 +751,16 @@ class Processor:
                         accuracy, self.arg.model_saved_name
                     )
                 )
-                self.print_log(f"torch metrics acc: {(100 * total_acc):>0.1f}%\n")
-                self.print_log(f"recall of every test dataset class:\n{total_recall}")
-                self.print_log(f"precision of every test dataset class:\n{total_precision}")
+                self.print_log(f"torch metrics acc: {(100 * accuracy):>0.1f}%\n")
+                self.print_log(
+                    f"recall of every test dataset class:\n{result['recall']}"
+                )
                 self.print_log(
-                    f"f1 score: {2*total_recall*total_precision/(total_recall+total_precision)}"
+                    f"precision of every test dataset class:\n{result['precision']}"
                 )
-                self.print_log("auc:", total_auc.item())
+                self.print_log(f"f1 score: {result['f1']}")
+                if "auroc" in result:
+                    self.print_log("auc: {}".format(result["auroc"]))
 
                 if self.arg.wandb:
                     wandb.log(
@@ -695,17 +778,11 @@ class Processor:
                 )
                 for k in self.arg.show_topk:
                     self.print_log(
-                        "\tTop{}: {:.2f}%".format(
-                            k, 100 * self.data_loader[ln].dataset.top_k(score, k)
-                        )
+                        "\tTop{}: {:.2f}%".format(k, 100 * result[f"top{k}"])
                     )
                     self.print_log(
                         "\tTop{} per-class: {:.2f}%".format(
-                            k,
-                            100
-                            * self.data_loader[ln].dataset.per_class_acc_top_k(
-                                score, k
-                            ),
+                            k, 100 * result[f"top{k}_per_class"]
                         )
                     )
 
@@ -730,6 +807,8 @@ class Processor:
                 * len(self.data_loader["train"])
                 / self.arg.batch_size
             )
+            if self.arg.compile:
+                self.compile_model(self.model)
             for epoch in range(self.arg.start_epoch, self.arg.num_epoch):
                 save_model = ((epoch + 1) % self.arg.save_interval == 0) or (
                     epoch + 1 == self.arg.num_epoch
@@ -772,6 +851,14 @@ class Processor:
             self.arg.print_log = False
             self.print_log("Model:   {}.".format(self.arg.model))
             self.print_log("Weights: {}.".format(self.arg.weights))
+            if self.arg.fuse_bn:
+                from model.fuse import fuse_for_inference
+
+                self.inference_model = fuse_for_inference(self.model)
+            if self.arg.compile:
+                self.compile_model(
+                    self.model if self.inference_model is None else self.inference_model
+                )
             self.eval(
                 epoch=self.test_epoch,
                 save_score=self.arg.save_score,
@@ -800,6 +887,11 @@ def str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
+def device_type(v):
+    # GPU index, or a device name such as cpu
+    return int(v) if str(v).isdigit() else v
+
+
 def import_class(name):
     components = name.split(".")
     mod = __import__(components[0])  # import return model
@@ -56,7 +56,7 @@ class MHSA(nn.Module):
         indy = ind.repeat_interleave(img_size, dim=0).repeat_interleave(img_size, dim=1)
         indd = indx**2 + indy**2
         distances = indd**0.5
-        distances = distances.to("cuda")
+        distances = distances.to(device=attn_map.device, dtype=attn_map.dtype)
 
         dist = torch.einsum("nm,hnm->h", (distances, attn_map))
         dist /= N
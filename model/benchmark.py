@@ -0,0 +1,238 @@
+"""Micro-benchmark of the einsum-heavy blocks of model.fstgan.
+
+    python -m model.benchmark --channels 64 512 --batch-size 8
+
+builds unit_san, Edge_feature_conv, unit_tan and global_tan at every
+channel width and reports, for one forward + backward pass, the FLOPs
+counted by torch.utils.flop_counter, the peak memory allocated during the
+pass, the median wall time and the resulting steps per second.
+
+    python -m model.benchmark --blocks unit_san --static-attention broadcast repeat
+
+times the static attention of unit_san as it is now, broadcast over the
+batch, next to the former path that repeated attention0s for every sample.
+
+    python -m model.benchmark --blocks Model --channels 64 --compile
+    python -m model.benchmark --blocks Model --channels 64 \
+        --batch-size 8 16 32 --checkpoint none block san mlp
+
+times the whole Model (inner_dim = channels, with DropBlock) as well. With
+--compile every entry is also run through torch.compile, reporting the
+time of the first, compiling, step; --checkpoint compares activation
+checkpointing of every Block ('block') or of its unit_san ('san') or MLP
+('mlp') part with none.
+"""
+
+import argparse
+import functools
+import itertools
+import time
+
+import numpy as np
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from graph.sign_27 import Graph
+from model import fstgan
+
+
+def repeated_static_attention(block, x):
+    # unit_san.static_attention before it broadcast attention0s over the batch
+    n, kc, t, v = x.size()
+    x = x.view(n, block.num_subset, kc // block.num_subset, t, v)
+    return torch.einsum(
+        "nkctv,nkcvw->nkctw", (x, block.attention0s.repeat(n, 1, 1, 1, 1))
+    ).view(n, -1, t, v)
+
+
+def build(name, channels, num_point, window, checkpoint="none"):
+    # the block, a function of its input and the shape of one input sample
+    A = Graph(labeling_mode="spatial").A
+    if name == "unit_san":
+        block = fstgan.unit_san(channels, channels, A, 16, num_point)
+        return block, lambda x: block(x), (channels, window, num_point)
+    if name == "Edge_feature_conv":
+        block = fstgan.Edge_feature_conv(channels, num_joint=num_point)
+        return block, lambda x: block(x), (channels, window, num_point)
+    if name in ["unit_tan", "global_tan"]:
+        block = getattr(fstgan, name)(
+            channels, channels, num_point=num_point, window_size=window
+        )
+        A = torch.from_numpy(A.sum(0).astype(np.float32))
+        return block, lambda x: block(x, 1.0, A), (channels, window, num_point)
+    if name == "Model":
+        block = fstgan.Model(
+            num_class=100,
+            num_point=num_point,
+            num_person=1,
+            graph="graph.sign_27.Graph",
+            graph_args=dict(labeling_mode="spatial"),
+            inner_dim=channels,
+            drop_layers=2,
+            window_size=window,
+            checkpoint_blocks=(
+                {} if checkpoint == "none" else {i: checkpoint for i in range(4)}
+            ),
+        )
+        return block, lambda x: block(x, 0.9), (3, window, num_point, 1)
+    raise ValueError(f"Unexpected block {name}")
+
+
+def step(run, x):
+    out = run(x)
+    out.sum().backward()
+
+
+def allocated(run, x):
+    # peak bytes above the baseline
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        step(run, x)
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    with torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        step(run, x)
+    # allocations and frees in order, the frees being [memory] events
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    return max(np.cumsum([e.self_cpu_memory_usage for e in events]).max(), 0)
+
+
+def wall_time(run, x, repeat, warmup=2):
+    for _ in range(warmup):
+        step(run, x)
+    times = []
+    for _ in range(repeat):
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        step(run, x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def benchmark(
+    name,
+    channels,
+    batch_size,
+    window,
+    num_point,
+    device,
+    repeat,
+    compile=False,
+    checkpoint="none",
+    static_attention="broadcast",
+):
+    block, run, shape = build(name, channels, num_point, window, checkpoint)
+    if static_attention == "repeat":
+        for m in block.modules():
+            if isinstance(m, fstgan.unit_san):
+                m.static_attention = functools.partial(repeated_static_attention, m)
+    block.to(device).train()
+    x = torch.randn(batch_size, *shape, device=device)
+    x.requires_grad_(True)
+
+    flops = FlopCounterMode(display=False)
+    with flops:
+        step(run, x)
+    compile_s = 0.0
+    if compile:
+        run = torch.compile(run)
+        start = time.perf_counter()
+        step(run, x)
+        compile_s = time.perf_counter() - start
+    ms = wall_time(run, x, repeat)
+    return dict(
+        gflops=flops.get_total_flops() / 1e9,
+        mb=allocated(run, x) / 2**20,
+        ms=ms,
+        steps=1000 / ms,
+        compile_s=compile_s,
+    )
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="FLOPs, memory and time of the einsum-heavy blocks"
+    )
+    parser.add_argument(
+        "--blocks",
+        default=["unit_san", "Edge_feature_conv", "unit_tan", "global_tan"],
+        nargs="+",
+        help="blocks of model.fstgan, or Model for the whole network",
+    )
+    parser.add_argument("--channels", type=int, default=[64, 512], nargs="+")
+    parser.add_argument("--batch-size", type=int, default=[8], nargs="+")
+    parser.add_argument("--window-size", type=int, default=120)
+    parser.add_argument("--num-point", type=int, default=27)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--compile", action="store_true", help="also time torch.compile'd blocks"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=["none"],
+        nargs="+",
+        choices=["none", "block", "san", "mlp"],
+        help="activation checkpointing of the Blocks of Model",
+    )
+    parser.add_argument(
+        "--static-attention",
+        default=["broadcast"],
+        nargs="+",
+        choices=["broadcast", "repeat"],
+        help="static attention of unit_san, repeat being the former per-sample copy",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    arg = get_parser().parse_args()
+    torch.manual_seed(0)
+    print(
+        "block\t\t\tchannels\tbatch\tcheckpoint\tstatic attention\tcompiled"
+        "\tGFLOPs\tMB\tms (forward + backward)\tsteps/s\tcompile s"
+    )
+    for name in arg.blocks:
+        checkpoints = arg.checkpoint if name == "Model" else ["none"]
+        attentions = (
+            arg.static_attention if name in ["unit_san", "Model"] else ["broadcast"]
+        )
+        for channels in arg.channels:
+            for batch_size in arg.batch_size:
+                for checkpoint, attention in itertools.product(checkpoints, attentions):
+                    for compile in [False, True] if arg.compile else [False]:
+                        r = benchmark(
+                            name,
+                            channels,
+                            batch_size,
+                            arg.window_size,
+                            arg.num_point,
+                            arg.device,
+                            arg.repeat,
+                            compile,
+                            checkpoint,
+                            attention,
+                        )
+                        print(
+                            "{:<20}\t{}\t\t{}\t{}\t\t{}\t\t{}\t\t{:.2f}\t{:.1f}"
+                            "\t{:.1f}\t\t\t{:.2f}\t{:.1f}".format(
+                                name,
+                                channels,
+                                batch_size,
+                                checkpoint,
+                                attention,
+                                compile,
+                                r["gflops"],
+                                r["mb"],
+                                r["ms"],
+                                r["steps"],
+                                r["compile_s"],
+                            )
+                        )
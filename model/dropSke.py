@@ -4,33 +4,56 @@ from torch import nn
 import warnings
 
 
+def skeleton_mask(input, keep_prob, A, num_point):
+    """(n, 1, 1, v) DropBlock mask over the joints of `input` (n, c, t, v).
+
+    Seeds are drawn per joint with a rate proportional to its mean activation
+    and spread to their neighbours in A. The mask is rescaled to mean 1, so
+    it only costs one broadcast multiply on the activations. The statistics
+    and the rescale are computed in fp32, also under autocast.
+    """
+    n, c, t, v = input.size()
+
+    input_abs = torch.mean(torch.abs(input.detach()), dim=(1, 2), dtype=torch.float32)
+    input_abs = input_abs / torch.sum(input_abs) * input_abs.numel()
+    if num_point == 25:  # Kinect V2
+        gamma = (1.0 - keep_prob) / (1 + 1.92)
+    elif num_point == 20:  # Kinect V1
+        gamma = (1.0 - keep_prob) / (1 + 1.9)
+    else:
+        gamma = (1.0 - keep_prob) / (1 + 1.92)
+    with torch.autocast(input.device.type, enabled=False):
+        M_seed = torch.bernoulli(torch.clamp(input_abs * gamma, max=1.0))
+        M = torch.matmul(M_seed, A.to(M_seed))
+        keep = (M <= 0.001).float()
+        mask = keep * (keep.numel() / keep.sum())
+    return mask.to(input.dtype).view(n, 1, 1, v)
+
+
 class DropBlock_Ske(nn.Module):
     def __init__(self, num_point, block_size=7):
         super(DropBlock_Ske, self).__init__()
         self.keep_prob = 0.0
         self.block_size = block_size
         self.num_point = num_point
+        if num_point not in [20, 25]:
+            # once here rather than per forward, which torch.compile cannot trace
+            warnings.warn("undefined skeleton graph")
+        # last mask applied, for siblings sharing it; None when nothing dropped
+        self.mask = None
+        # reuse self.mask, when recomputed by activation checkpointing
+        self.replay = False
 
-    def forward(self, input, keep_prob, A):  # n,c,t,v
+    def forward(self, input, keep_prob, A, mask=None):  # n,c,t,v
         self.keep_prob = keep_prob
         if not self.training or self.keep_prob == 1:
+            self.mask = None
             return input
-        n, c, t, v = input.size()
-
-        input_abs = torch.mean(torch.mean(torch.abs(input), dim=2), dim=1).detach()
-        input_abs = input_abs / torch.sum(input_abs) * input_abs.numel()
-        if self.num_point == 25:  # Kinect V2
-            gamma = (1.0 - self.keep_prob) / (1 + 1.92)
-        elif self.num_point == 20:  # Kinect V1
-            gamma = (1.0 - self.keep_prob) / (1 + 1.9)
-        else:
-            gamma = (1.0 - self.keep_prob) / (1 + 1.92)
-            warnings.warn("undefined skeleton graph")
-        M_seed = torch.bernoulli(torch.clamp(input_abs * gamma, max=1.0)).to(
-            device=input.device, dtype=input.dtype
-        )
-        M = torch.matmul(M_seed, A)
-        M[M > 0.001] = 1.0
-        M[M < 0.5] = 0.0
-        mask = (1 - M).view(n, 1, 1, self.num_point)
-        return input * mask * mask.numel() / mask.sum()
+        if mask is None:
+            mask = (
+                self.mask
+                if self.replay
+                else skeleton_mask(input, keep_prob, A, self.num_point)
+            )
+        self.mask = mask
+        return input * mask
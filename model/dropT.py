@@ -3,29 +3,46 @@ import torch.nn.functional as F
 from torch import nn
 
 
+def temporal_mask(input, keep_prob, block_size):
+    """(n, 1, t, 1) DropBlock mask over the frames of `input` (n, c, t, v).
+
+    The mask is the same for every channel and joint, so it is built at
+    (n, 1, t) and broadcast instead of being repeated c * v times, and it is
+    rescaled to mean 1 before touching the activations. The statistics and
+    the rescale are computed in fp32, also under autocast.
+    """
+    n, c, t, v = input.size()
+
+    input_abs = torch.mean(torch.abs(input.detach()), dim=(1, 3), dtype=torch.float32)
+    input_abs = (input_abs / torch.sum(input_abs) * input_abs.numel()).view(n, 1, t)
+    gamma = (1.0 - keep_prob) / block_size
+    M = torch.bernoulli(torch.clamp(input_abs * gamma, max=1.0))
+    Msum = F.max_pool1d(M, kernel_size=[block_size], stride=1, padding=block_size // 2)
+    keep = 1 - Msum
+    mask = keep * (keep.numel() / keep.sum())
+    return mask.to(input.dtype).view(n, 1, t, 1)
+
+
 class DropBlockT_1d(nn.Module):
     def __init__(self, block_size=7):
         super(DropBlockT_1d, self).__init__()
         self.keep_prob = 0.0
         self.block_size = block_size
+        # last mask applied, for siblings sharing it; None when nothing dropped
+        self.mask = None
+        # reuse self.mask, when recomputed by activation checkpointing
+        self.replay = False
 
-    def forward(self, input, keep_prob):
+    def forward(self, input, keep_prob, mask=None):
         self.keep_prob = keep_prob
         if not self.training or self.keep_prob == 1:
+            self.mask = None
             return input
-        n, c, t, v = input.size()
-
-        input_abs = torch.mean(torch.mean(torch.abs(input), dim=3), dim=1).detach()
-        input_abs = (input_abs / torch.sum(input_abs) * input_abs.numel()).view(n, 1, t)
-        gamma = (1.0 - self.keep_prob) / self.block_size
-        input1 = input.permute(0, 1, 3, 2).contiguous().view(n, c * v, t)
-        M = torch.bernoulli(torch.clamp(input_abs * gamma, max=1.0)).repeat(1, c * v, 1)
-        Msum = F.max_pool1d(
-            M, kernel_size=[self.block_size], stride=1, padding=self.block_size // 2
-        )
-        mask = (1 - Msum).to(device=input.device, dtype=input.dtype)
-        return (
-            (input1 * mask * mask.numel() / mask.sum())
-            .view(n, c, v, t)
-            .permute(0, 1, 3, 2)
-        )
+        if mask is None:
+            mask = (
+                self.mask
+                if self.replay
+                else temporal_mask(input, keep_prob, self.block_size)
+            )
+        self.mask = mask
+        return input * mask
@@ -0,0 +1,185 @@
+"""Export model.fstgan.Model to an inference-only TorchScript or ONNX graph.
+
+    python -m model.export --config config/test.yaml \
+        --weights ./pretrained_models/pretrained_model_for_WLASL2000.pt \
+        --format torchscript
+
+builds the model of the config, loads the weights, folds the BatchNorms
+with model.fuse.fuse_for_inference and traces it with keep_prob fixed to 1,
+so the DropBlocks are not part of the graph. The exported file is loaded
+back, compared with the eager model and timed on CPU for every
+--batch-sizes. The batch dimension stays dynamic in both formats.
+"""
+
+import argparse
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import yaml
+
+from model.attention import import_class
+from model.fuse import fuse_for_inference
+
+
+class InferenceModel(nn.Module):
+    """Eval-only Model: keep_prob is 1, so every DropBlock returns its input."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, 1.0)
+
+
+def inference_graph(model):
+    """A folded eval-mode copy of `model` that only takes the input."""
+    return InferenceModel(fuse_for_inference(model)).eval()
+
+
+def export(model, path, format, example):
+    with torch.no_grad():
+        if format == "torchscript":
+            traced = torch.jit.trace(model, example)
+            torch.jit.save(torch.jit.freeze(traced), path)
+        elif format == "onnx":
+            import onnx  # noqa: F401, needed by torch.onnx.export
+
+            torch.onnx.export(
+                model,
+                (example,),
+                path,
+                input_names=["x"],
+                output_names=["score"],
+                dynamic_axes={"x": {0: "batch"}, "score": {0: "batch"}},
+                dynamo=False,
+            )
+        else:
+            raise ValueError(f"Unexpected export format {format}")
+    return path
+
+
+def load(path, format):
+    """A function mapping an (N, C, T, V, M) float32 array to the scores."""
+    if format == "torchscript":
+        module = torch.jit.load(path, map_location="cpu")
+
+        def run(x):
+            with torch.no_grad():
+                return module(torch.from_numpy(x)).numpy()
+
+    else:
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+        def run(x):
+            return session.run(None, {"x": x})[0]
+
+    return run
+
+
+def load_model(config, weights=None):
+    with open(config, "r") as f:
+        arg = yaml.safe_load(f)
+    model = import_class(arg["model"])(**arg["model_args"])
+    if weights:
+        ckpt = torch.load(weights, map_location="cpu", weights_only=False)
+        ckpt = ckpt.get("weights", ckpt)
+        model.load_state_dict(
+            OrderedDict([[k.split("module.")[-1], v] for k, v in ckpt.items()])
+        )
+    window_size = arg.get("test_feeder_args", dict()).get("window_size", 120)
+    return model.eval(), arg["model_args"], window_size
+
+
+def example_input(model_args, window_size, batch_size=1, in_channels=3):
+    return np.random.randn(
+        batch_size,
+        in_channels,
+        window_size,
+        model_args["num_point"],
+        model_args["num_person"],
+    ).astype(np.float32)
+
+
+def latency(run, x, repeat=20, warmup=3):
+    # median wall time of one call in ms
+    for _ in range(warmup):
+        run(x)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(x)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Export the model to TorchScript or ONNX for CPU inference"
+    )
+    parser.add_argument("--config", required=True, help="training or test config")
+    parser.add_argument("--weights", default=None, help="checkpoint to export")
+    parser.add_argument(
+        "--format", default="torchscript", choices=["torchscript", "onnx"]
+    )
+    parser.add_argument("--output", default=None, help="exported file")
+    parser.add_argument(
+        "--batch-sizes",
+        type=int,
+        default=[1, 8, 32],
+        nargs="+",
+        help="batch sizes of the parity check and latency report",
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per size")
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+    parser.add_argument(
+        "--rtol",
+        type=float,
+        default=1e-5,
+        help="max score difference allowed, relative to the largest |score|",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    arg = get_parser().parse_args()
+    if arg.threads:
+        torch.set_num_threads(arg.threads)
+    output = arg.output or "model.{}".format(
+        "pt" if arg.format == "torchscript" else "onnx"
+    )
+
+    model, model_args, window_size = load_model(arg.config, arg.weights)
+    example = torch.from_numpy(example_input(model_args, window_size, 2))
+    export(inference_graph(model), output, arg.format, example)
+    run = load(output, arg.format)
+    print("wrote {}".format(output))
+
+    print("batch\teager ms\t{} ms\tsamples/s\tmax rel diff".format(arg.format))
+    for batch_size in arg.batch_sizes:
+        x = example_input(model_args, window_size, batch_size)
+        eager = torch.no_grad()(lambda x: model(torch.from_numpy(x), 1.0).numpy())
+        score = eager(x)
+        diff = np.abs(run(x) - score).max() / np.abs(score).max()
+        eager_ms = latency(eager, x, arg.repeat)
+        export_ms = latency(run, x, arg.repeat)
+        print(
+            "{}\t{:.2f}\t\t{:.2f}\t\t{:.1f}\t\t{:.2e}".format(
+                batch_size,
+                eager_ms,
+                export_ms,
+                1000 * batch_size / export_ms,
+                diff,
+            )
+        )
+        if diff > arg.rtol:
+            raise SystemExit(
+                "exported model differs from eager mode by {:.2e}".format(diff)
+            )
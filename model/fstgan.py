@@ -1,8 +1,10 @@
+import contextlib
 from functools import partial
 from unittest.mock import patch
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 import math
 
@@ -15,9 +17,18 @@ from einops import rearrange
 
 class unit_san(nn.Module):
     def __init__(
-        self, in_channels, out_channels, A, groups, num_point, num_subset=3, **kwargs
+        self,
+        in_channels,
+        out_channels,
+        A,
+        groups,
+        num_point,
+        num_subset=3,
+        checkpoint_mlp=False,
+        **kwargs,
     ):
         super().__init__()
+        self.checkpoint_mlp = checkpoint_mlp
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.num_point = num_point
@@ -37,7 +48,7 @@ class unit_san(nn.Module):
                 nn.Conv2d(in_channels, out_channels, 1), nn.BatchNorm2d(out_channels)
             )
         else:
-            self.down = lambda x: x
+            self.down = nn.Identity()
 
         self.bn = nn.BatchNorm2d(out_channels)
         self.relu = nn.ReLU()
@@ -92,7 +103,6 @@ class unit_san(nn.Module):
                 in_channels,
                 self.inter_channels * num_subset,
                 requires_grad=True,
-                device="cuda",
             ),
             requires_grad=True,
         )
@@ -107,7 +117,6 @@ class unit_san(nn.Module):
                 1,
                 1,
                 requires_grad=True,
-                device="cuda",
             ),
             requires_grad=True,
         )
@@ -118,18 +127,44 @@ class unit_san(nn.Module):
 
     def norm(self, A):
         b, c, h, w = A.size()
-        A = A.view(c, self.num_point, self.num_point)
-        D_list = torch.sum(A, 1).view(c, 1, self.num_point)
-        D_list_12 = (D_list + 0.001) ** (-1)
-        D_12 = self.eyes * D_list_12
-        A = torch.bmm(A, D_12).view(b, c, h, w)
+        # in fp32 under autocast, (D + 0.001) ** (-1) overflows fp16
+        with torch.autocast(A.device.type, enabled=False):
+            A = A.float().view(c, self.num_point, self.num_point)
+            D_list = torch.sum(A, 1).view(c, 1, self.num_point)
+            D_list_12 = (D_list + 0.001) ** (-1)
+            D_12 = self.eyes * D_list_12
+            A = torch.bmm(A, D_12).view(b, c, h, w)
         return A
 
+    def project(self, x0):
+        # model.fuse folds data_bn into per-joint (V, C, D) weights
+        if self.Linear_weight.dim() == 3:
+            x = torch.einsum("nctv,vcd->ndtv", x0, self.Linear_weight)
+        else:
+            x = torch.einsum("nctw,cd->ndtw", (x0, self.Linear_weight)).contiguous()
+        return x + self.Linear_bias
+
+    def static_attention(self, x):
+        n, kc, t, v = x.size()
+        x = x.view(n, self.num_subset, kc // self.num_subset, t, v)
+        # broadcast the static attention over the batch instead of repeating it
+        # (model.benchmark --static-attention repeat times the repeated copy)
+        return torch.einsum("nkctv,kcvw->nkctw", x, self.attention0s[0]).reshape(
+            n, -1, t, v
+        )
+
+    def mlp_residual(self, x):
+        # x + MLP(LayerNorm(x)), whose 4x wide hidden layer is the largest activation
+        n = x.size(0)
+        x_resi = x
+        x = rearrange(x, "b c t v -> (b t) v c")
+        x = self.norm2(x)
+        return x_resi + rearrange(self.mlp(x), "(b t) v c -> b c t v", b=n)
+
     def forward(self, x0):
         # x = self.attention_block(x0)
 
-        x = torch.einsum("nctw,cd->ndtw", (x0, self.Linear_weight)).contiguous()
-        x = x + self.Linear_bias
+        x = self.project(x0)
         x = self.bn0(x)
 
         n, c, t, v = x.size()
@@ -145,26 +180,24 @@ class unit_san(nn.Module):
             2,
             dim=1,
         )  # nctv -> n num_subset c'tv
-        attention = (
-            self.tan(
-                torch.einsum("nkctu,nkctv->nkuv", [q, k]) / (self.inter_channels * t)
+        # the q.k sums over inter_channels * t terms, kept in fp32 under autocast
+        with torch.autocast(x.device.type, enabled=False):
+            attention = (
+                self.tan(
+                    torch.einsum("nkctu,nkctv->nkuv", [q.float(), k.float()])
+                    / (self.inter_channels * t)
+                )
+                * self.alphas
             )
-            * self.alphas
-        )
         x = x.view(n, self.num_subset, -1, t, v)
         x = torch.einsum("nkctv,nkvw->nkctw", (x, attention)).view(n, -1, t, v) + x_resi
 
-        x_resi = x
-        x = rearrange(x, "b c t v -> (b t) v c")
-        x = self.norm2(x)
-        x = x_resi + rearrange(self.mlp(x), "(b t) v c -> b c t v", b=n) + edge_features
-
-        n, kc, t, v = x.size()
-        x = x.view(n, self.num_subset, kc // self.num_subset, t, v)
-        x = torch.einsum(
-            "nkctv,nkcvw->nkctw", (x, self.attention0s.repeat(n, 1, 1, 1, 1))
-        ).view(n, -1, t, v)
-        # x = torch.einsum('nkctv,nkcvw->nctw', (x, self.attention0s.repeat(n,1,1,1,1)))
+        if self.checkpoint_mlp and self.training and torch.is_grad_enabled():
+            x = checkpoint(self.mlp_residual, x, use_reentrant=False)
+        else:
+            x = self.mlp_residual(x)
+        x = x + edge_features
+        x = self.static_attention(x)
 
         x = self.bn(x)
         x += self.down(x0)
@@ -172,6 +205,12 @@ class unit_san(nn.Module):
         return x
 
 
+class zero_residual(nn.Module):
+    # a module rather than a lambda, so the model can be pickled and traced
+    def forward(self, x):
+        return 0
+
+
 class unit_tcn_skip(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=1, stride=1):
         super(unit_tcn_skip, self).__init__()
@@ -441,6 +480,31 @@ class Edge_feature_conv(nn.Module):
         return x
 
 
+def replay_drop_masks(module):
+    """context_fn of torch.utils.checkpoint for a module with DropBlocks.
+
+    The forward pass draws the masks as usual and every DropBlock keeps its
+    last one; the recomputation in backward reuses those masks instead of
+    drawing new ones, so both passes drop the same joints and frames. This
+    assumes one forward per backward, as in Processor.train.
+    """
+    drops = [
+        m for m in module.modules() if isinstance(m, (DropBlock_Ske, DropBlockT_1d))
+    ]
+
+    @contextlib.contextmanager
+    def replay():
+        for m in drops:
+            m.replay = True
+        try:
+            yield
+        finally:
+            for m in drops:
+                m.replay = False
+
+    return contextlib.nullcontext(), replay()
+
+
 class Block(nn.Module):
     def __init__(
         self,
@@ -455,10 +519,17 @@ class Block(nn.Module):
         use_grpe=True,
         is_first=False,
         window_size=120,
-        **kwargs
+        share_drop_mask=False,
+        checkpoint=None,
+        **kwargs,
     ):
 
         super().__init__()
+        self.share_drop_mask = share_drop_mask
+        # None, or the part recomputed in backward: "block", "san" or "mlp"
+        if checkpoint not in [None, "block", "san", "mlp"]:
+            raise ValueError(f"Unexpected checkpoint part {checkpoint}")
+        self.checkpoint = checkpoint
         tmp_c = out_channels if is_first else in_channels
         self.san = unit_san(
             in_channels,
@@ -468,7 +539,8 @@ class Block(nn.Module):
             num_point,
             is_first=is_first,
             use_grpe=use_grpe,
-            **kwargs
+            checkpoint_mlp=checkpoint == "mlp",
+            **kwargs,
         )
 
         # self.tcn = unit_tcn(tmp_c, out_channels, stride=stride, num_point=num_point)
@@ -524,10 +596,10 @@ class Block(nn.Module):
         )
 
         if not residual:
-            self.residual = lambda x: 0
+            self.residual = zero_residual()
 
         elif (in_channels == out_channels) and (stride == 1):
-            self.residual = lambda x: x
+            self.residual = nn.Identity()
 
         else:
             self.residual = unit_tcn_skip(
@@ -537,7 +609,24 @@ class Block(nn.Module):
         self.dropT_skip = DropBlockT_1d(block_size=block_size)
 
     def forward(self, x, keep_prob):
-        y = self.san(x)
+        if self.checkpoint == "block" and self.training and torch.is_grad_enabled():
+            if torch.compiler.is_compiling():
+                # torch.compile takes no custom context_fn, it replays the RNG itself
+                return checkpoint(self._forward, x, keep_prob, use_reentrant=False)
+            return checkpoint(
+                self._forward,
+                x,
+                keep_prob,
+                use_reentrant=False,
+                context_fn=partial(replay_drop_masks, self),
+            )
+        return self._forward(x, keep_prob)
+
+    def _forward(self, x, keep_prob):
+        if self.checkpoint == "san" and self.training and torch.is_grad_enabled():
+            y = checkpoint(self.san, x, use_reentrant=False)
+        else:
+            y = self.san(x)
         if self.attention:
             # spatial attention
             se = y.mean(-2)  # N C V
@@ -563,13 +652,32 @@ class Block(nn.Module):
         y = self.tcn3(y, keep_prob, self.A)
         # y = self.tcn4(y, keep_prob, self.A)
         # y = self.tcn(y, keep_prob, self.A) + self.tcn2(y, keep_prob, self.A) * self.weight
-        x_skip = self.dropT_skip(
-            self.dropSke(self.residual(x), keep_prob, self.A), keep_prob
-        )
+        if isinstance(self.residual, zero_residual):
+            return self.relu(y)
+        if self.share_drop_mask:
+            # drop the same joints and frames as the last temporal layer
+            x_skip = self.dropT_skip(
+                self.dropSke(self.residual(x), keep_prob, self.A, self.tcn3.dropS.mask),
+                keep_prob,
+                self.tcn3.dropT.mask,
+            )
+        else:
+            x_skip = self.dropT_skip(
+                self.dropSke(self.residual(x), keep_prob, self.A), keep_prob
+            )
         return self.relu(y + x_skip)
 
 
 class MSTCN(nn.Module):
+    """Parallel temporal convolutions with different kernel sizes, fused.
+
+    Every branch kernel is zero-padded to the largest one, so the branches
+    run as one conv whose output channels are the concatenated branches,
+    followed by one BatchNorm and one pair of DropBlocks. The padded taps are
+    masked to stay zero. Checkpoints of the per-branch version
+    (branches.<i>.conv / branches.<i>.bn) are remapped when loaded.
+    """
+
     def __init__(
         self,
         in_channels,
@@ -585,34 +693,142 @@ class MSTCN(nn.Module):
         assert (
             out_channels % (self.num_branches) == 0
         ), "# out channels should be multiples of # branches"
+        assert all(k % 2 for k in kernel_sizes), "kernel sizes should be odd"
+        self.kernel_sizes = kernel_sizes
 
         # Multiple branches of temporal convolution
         branch_channels = out_channels // self.num_branches
-
-        # Temporal Convolution branches
-        self.branches = nn.ModuleList(
-            [
-                unit_tcn(
-                    in_channels,
-                    branch_channels,
-                    kernel_size=kernel_size,
-                    stride=stride,
-                    num_point=num_point,
-                    block_size=block_size,
-                )
-                for kernel_size in kernel_sizes
-            ]
+        kernel_size = max(kernel_sizes)
+        self.conv = nn.Conv2d(
+            in_channels,
+            out_channels,
+            kernel_size=(kernel_size, 1),
+            padding=((kernel_size - 1) // 2, 0),
+            stride=(stride, 1),
+        )
+        self.bn = nn.BatchNorm2d(out_channels)
+        self.register_buffer(
+            "kernel_mask",
+            torch.zeros(out_channels, 1, kernel_size, 1),
+            persistent=False,
         )
 
+        # initialise every branch as its own unit_tcn conv
+        with torch.no_grad():
+            for i, k in enumerate(kernel_sizes):
+                branch = nn.Conv2d(in_channels, branch_channels, kernel_size=(k, 1))
+                conv_init(branch)
+                rows = slice(i * branch_channels, (i + 1) * branch_channels)
+                taps = slice((kernel_size - k) // 2, (kernel_size + k) // 2)
+                self.conv.weight[rows] = 0
+                self.conv.weight[rows, :, taps] = branch.weight
+                self.conv.bias[rows] = branch.bias
+                self.kernel_mask[rows, :, taps] = 1
+        bn_init(self.bn, 1)
+
+        self.dropS = DropBlock_Ske(num_point=num_point)
+        self.dropT = DropBlockT_1d(block_size=block_size)
+
+    def fuse_branches(self, state_dict, prefix):
+        # branches.<i>.conv / branches.<i>.bn entries of state_dict -> conv / bn
+        kernel_size = max(self.kernel_sizes)
+        for name in [
+            "conv.weight",
+            "conv.bias",
+            "bn.weight",
+            "bn.bias",
+            "bn.running_mean",
+            "bn.running_var",
+        ]:
+            keys = [prefix + f"branches.{i}.{name}" for i in range(self.num_branches)]
+            if keys[0] not in state_dict:
+                continue
+            parts = [state_dict.pop(k) for k in keys]
+            if name == "conv.weight":
+                pads = [(kernel_size - w.shape[2]) // 2 for w in parts]
+                parts = [F.pad(w, (0, 0, pad, pad)) for w, pad in zip(parts, pads)]
+            state_dict[prefix + name] = torch.cat(parts)
+        tracked = [
+            state_dict.pop(prefix + f"branches.{i}.bn.num_batches_tracked", None)
+            for i in range(self.num_branches)
+        ]
+        if tracked[0] is not None:
+            state_dict[prefix + "bn.num_batches_tracked"] = tracked[0]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self.fuse_branches(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x, keep_prob, A):
         # Input dim: (N,C,T,V)
-        branch_outs = []
-        for tempconv in self.branches:
-            out = tempconv(x, keep_prob, A)
-            branch_outs.append(out)
+        x = F.conv2d(
+            x,
+            self.conv.weight * self.kernel_mask,
+            self.conv.bias,
+            stride=self.conv.stride,
+            padding=self.conv.padding,
+        )
+        x = self.bn(x)
+        x = self.dropT(self.dropS(x, keep_prob, A), keep_prob)
+        return x
 
-        out = torch.cat(branch_outs, dim=1)
-        return out
+
+def fuse_branch_optimizer_state(model, optimizer_state, weights):
+    """Optimizer state of a checkpoint with per-branch MSTCNs, for `model`.
+
+    `weights` are the model weights of the same checkpoint; their parameters
+    give the order the optimizer state is indexed in. Per-parameter buffers
+    (SGD momentum, Adam moments) are fused like the weights they belong to,
+    param_groups keep their settings and lose the later branches.
+    """
+    model = getattr(model, "module", model)
+    names = [n for n, _ in model.named_parameters()]
+    index = {n: i for i, n in enumerate(names)}
+    mstcns = {n + ".": m for n, m in model.named_modules() if isinstance(m, MSTCN)}
+
+    def fused_name(name):
+        prefix, _, rest = name.partition("branches.")
+        if prefix in mstcns:
+            return prefix + rest.split(".", 1)[1]
+        return name
+
+    old_names = [k.split("module.")[-1] for k in weights.keys()]
+    old_names = [k for k in old_names if fused_name(k) in index]
+    old_index = [i for g in optimizer_state["param_groups"] for i in g["params"]]
+    if len(old_names) != len(old_index):
+        raise ValueError(
+            "{} parameters in the weights, {} in the optimizer state".format(
+                len(old_names), len(old_index)
+            )
+        )
+    old_name = dict(zip(old_index, old_names))
+
+    param_groups, seen = [], set()
+    for group in optimizer_state["param_groups"]:
+        params = []
+        for i in group["params"]:
+            j = index[fused_name(old_name[i])]
+            if j not in seen:
+                seen.add(j)
+                params.append(j)
+        if params:
+            param_groups.append(dict(group, params=params))
+
+    fields = {}
+    for i, s in optimizer_state["state"].items():
+        for field, v in s.items():
+            fields.setdefault(field, {})[old_name[i]] = v
+    state = {}
+    for field, values in fields.items():
+        if all(torch.is_tensor(v) and v.dim() > 0 for v in values.values()):
+            for prefix, m in mstcns.items():
+                m.fuse_branches(values, prefix)
+        else:
+            # e.g. Adam's step, the same for every branch
+            values = {fused_name(k): v for k, v in reversed(list(values.items()))}
+        for k, v in values.items():
+            state.setdefault(index[k], {})[field] = v
+    return dict(state=state, param_groups=param_groups)
 
 
 class MultiScale_TemporalConv(nn.Module):
@@ -738,6 +954,8 @@ class Model(nn.Module):
         depth=4,
         s_num_heads=1,
         window_size=120,
+        share_drop_mask=False,
+        checkpoint_blocks=[],
     ):
         super(Model, self).__init__()
 
@@ -752,6 +970,10 @@ class Model(nn.Module):
 
         self.drop_layers = depth - drop_layers
 
+        # block indices, or {index: "block" | "san" | "mlp"}, to recompute in backward
+        if not isinstance(checkpoint_blocks, dict):
+            checkpoint_blocks = {i: "block" for i in checkpoint_blocks}
+
         inner_dim_expansion = [2 ** (i) for i in range(0, depth)]
 
         self.layers = nn.ModuleList(
@@ -767,6 +989,8 @@ class Model(nn.Module):
                         residual=False,
                         window_size=window_size,
                         i=i,
+                        share_drop_mask=share_drop_mask,
+                        checkpoint=checkpoint_blocks.get(i),
                         is_first=True,
                     )
                     if i == 0
@@ -781,6 +1005,8 @@ class Model(nn.Module):
                         residual=True,
                         window_size=window_size // inner_dim_expansion[i],
                         i=i,
+                        share_drop_mask=share_drop_mask,
+                        checkpoint=checkpoint_blocks.get(i),
                     )
                 )
                 for i in range(depth)
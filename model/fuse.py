@@ -0,0 +1,170 @@
+"""Fold the BatchNorms of model.fstgan.Model into the layers before them.
+
+In eval mode a BatchNorm is the per-channel affine map s * x + t with
+s = weight / sqrt(running_var + eps) and t = bias - running_mean * s, so it
+can be merged into the weights and bias of a preceding conv or linear map:
+
+- MSTCN / unit_tcn / unit_tcn_dilated / TemporalConv: conv -> bn
+- unit_tcn_skip: depthwise 1x1 conv -> pointwise conv -> bn, one 1x1 conv
+- unit_san: the einsum projection Linear_weight / Linear_bias -> bn0, and
+  conv -> bn on the `down` path
+- Model.data_bn: scales every (joint, channel) of the input, so it is folded
+  into per-joint (V, C, D) weights of the first block's projection and
+  `down` path (only with one person, whose input feeds nothing else)
+
+The result is meant for inference only; its state dict no longer matches
+the training checkpoints.
+"""
+
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from model import fstgan
+
+
+class JointLinear(nn.Module):
+    """(N, C, T, V) -> (N, D, T, V) with a (C, D) weight per joint."""
+
+    def __init__(self, weight, bias):
+        super().__init__()
+        self.weight = nn.Parameter(weight, requires_grad=False)  # V, C, D
+        self.bias = nn.Parameter(bias, requires_grad=False)  # 1, D, 1, V
+
+    def forward(self, x):
+        return torch.einsum("nctv,vcd->ndtv", x, self.weight) + self.bias
+
+
+def bn_affine(bn):
+    # eval-mode BatchNorm as scale * x + shift
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale, shift
+
+
+def _fold(conv_owner, conv_name, bn_owner, bn_name):
+    conv, bn = getattr(conv_owner, conv_name), getattr(bn_owner, bn_name)
+    setattr(conv_owner, conv_name, fuse_conv_bn_eval(conv, bn))
+    setattr(bn_owner, bn_name, nn.Identity())
+
+
+def _merge_pointwise(depthwise, pointwise):
+    # depthwise 1x1 (per-channel scale) followed by a pointwise 1x1 conv
+    conv = (
+        nn.Conv2d(
+            depthwise.in_channels,
+            pointwise.out_channels,
+            kernel_size=1,
+            stride=depthwise.stride,
+            bias=True,
+        )
+        .to(pointwise.weight)
+        .eval()
+    )
+    w_pw = pointwise.weight[:, :, 0, 0]
+    conv.weight.copy_((w_pw * depthwise.weight.view(1, -1))[:, :, None, None])
+    bias = torch.zeros_like(conv.bias)
+    if depthwise.bias is not None:
+        bias = bias + w_pw @ depthwise.bias
+    if pointwise.bias is not None:
+        bias = bias + pointwise.bias
+    conv.bias.copy_(bias)
+    return conv
+
+
+def fold_tcn_skip(m):
+    depthwise, pointwise = m.pool.net
+    if (
+        depthwise.kernel_size == (1, 1)
+        and depthwise.padding == (0, 0)
+        and depthwise.groups == depthwise.in_channels == depthwise.out_channels
+    ):
+        m.pool = fuse_conv_bn_eval(_merge_pointwise(depthwise, pointwise), m.bn)
+    else:
+        m.pool.net[1] = fuse_conv_bn_eval(pointwise, m.bn)
+    m.bn = nn.Identity()
+
+
+def fold_san_projection(m):
+    scale, shift = bn_affine(m.bn0)
+    weight = m.Linear_weight * scale  # (C, D) or (V, C, D)
+    bias = m.Linear_bias * scale.view(1, -1, 1, 1) + shift.view(1, -1, 1, 1)
+    m.Linear_weight = nn.Parameter(weight, requires_grad=False)
+    m.Linear_bias = nn.Parameter(bias, requires_grad=False)
+    m.bn0 = nn.Identity()
+
+
+def _down_weight(down, in_channels, like):
+    # the `down` path as a (C, D) weight and (D,) bias, or None if it is not 1x1
+    if isinstance(down, nn.Identity):
+        return torch.eye(in_channels).to(like), torch.zeros(in_channels).to(like)
+    if isinstance(down, nn.Sequential) and isinstance(down[1], nn.Identity):
+        conv = down[0]
+        if conv.kernel_size == (1, 1) and conv.stride == (1, 1):
+            return conv.weight[:, :, 0, 0].T, conv.bias
+    return None
+
+
+def fold_data_bn(model):
+    block = model.layers[0]
+    san = block.san
+    V = san.num_point
+    C = san.Linear_weight.shape[0]
+    down = _down_weight(san.down, C, san.Linear_weight)
+    if (
+        model.data_bn.num_features != V * C
+        or not isinstance(block.residual, fstgan.zero_residual)
+        or san.Linear_weight.dim() != 2
+        or down is None
+    ):
+        return False
+
+    # input channel m*V*C + v*C + c with M == 1
+    scale, shift = (a.view(V, C) for a in bn_affine(model.data_bn))
+
+    def per_joint(weight, bias):
+        # W (C, D), b (D,) applied to scale * x + shift
+        joint_weight = scale[:, :, None] * weight[None]
+        joint_bias = bias.view(-1, 1) + torch.einsum("cd,vc->dv", weight, shift)
+        return joint_weight, joint_bias.unsqueeze(0).unsqueeze(2)
+
+    weight, bias = per_joint(san.Linear_weight, san.Linear_bias.view(-1))
+    san.Linear_weight = nn.Parameter(weight, requires_grad=False)
+    san.Linear_bias = nn.Parameter(bias, requires_grad=False)
+    san.down = JointLinear(*per_joint(*down))
+    model.data_bn = nn.Identity()
+    return True
+
+
+@torch.no_grad()
+def fuse_for_inference(model):
+    """An eval-mode copy of `model` with its BatchNorms folded away."""
+    if isinstance(model, nn.DataParallel):
+        return nn.DataParallel(
+            fuse_for_inference(model.module),
+            device_ids=model.device_ids,
+            output_device=model.output_device,
+        )
+    model = copy.deepcopy(model).eval()
+    for m in list(model.modules()):
+        if isinstance(m, (fstgan.unit_tcn, fstgan.unit_tcn_dilated)):
+            _fold(m, "conv", m, "bn")
+        elif isinstance(m, (fstgan.MSTCN, fstgan.TemporalConv)):
+            _fold(m, "conv", m, "bn")
+        elif isinstance(m, fstgan.unit_tcn_skip):
+            fold_tcn_skip(m)
+        elif isinstance(m, fstgan.unit_san):
+            if isinstance(m.down, nn.Sequential):
+                _fold(m.down, "0", m.down, "1")
+            fold_san_projection(m)
+    if isinstance(model, fstgan.Model):
+        fold_data_bn(model)
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model
@@ -0,0 +1,32 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from model import fstgan
+
+MODEL_ARGS = dict(
+    num_class=10,
+    num_point=27,
+    num_person=1,
+    graph="graph.sign_27.Graph",
+    graph_args=dict(labeling_mode="spatial"),
+    inner_dim=16,
+    depth=2,
+    drop_layers=1,
+    window_size=16,
+)
+
+
+@pytest.fixture
+def model():
+    """A small eval-mode Model whose BatchNorms are not the identity."""
+    torch.manual_seed(0)
+    model = fstgan.Model(**MODEL_ARGS)
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.modules.batchnorm._BatchNorm):
+                m.running_mean.normal_()
+                m.running_var.uniform_(0.5, 2.0)
+                m.weight.normal_()
+                m.bias.normal_()
+    return model.eval()
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+
+from feeders import batch_augment, tools
+from feeders.feeder import flip_index
+
+
+def batch(num, T=20, V=27, seed=0):
+    # one random sample repeated, so every draw starts from the same input
+    sample = np.random.default_rng(seed).random((3, T, V, 1)) * 512
+    return sample, torch.tensor(sample).unsqueeze(0).repeat(num, 1, 1, 1, 1)
+
+
+@pytest.mark.parametrize("is_vector", [False, True])
+def test_random_mirror(is_vector):
+    sample, data = batch(2000)
+    flipped = sample[:, :, flip_index].copy()
+    flipped[0] = -flipped[0] if is_vector else 512 - flipped[0]
+    out = batch_augment.random_mirror(
+        data, p=0.3, is_vector=is_vector, generator=torch.Generator().manual_seed(0)
+    ).numpy()
+    # every sample is either untouched or the Feeder's flip of it
+    is_flipped = np.array([np.array_equal(o, flipped) for o in out])
+    is_kept = np.array([np.array_equal(o, sample) for o in out])
+    assert (is_flipped | is_kept).all()
+    # flipped when a uniform draw exceeds p; 4 standard errors of 2000 draws
+    assert abs(is_flipped.mean() - 0.7) < 4 * np.sqrt(0.7 * 0.3 / 2000)
+
+
+@pytest.mark.parametrize("is_vector", [False, True])
+def test_center(is_vector):
+    sample, data = batch(2)
+    ref = sample.copy()
+    # the normalization part of Feeder.__getitem__
+    for c in range(2):
+        if is_vector:
+            ref[c, :, 0, :] = ref[c, :, 0, :] - ref[c, :, 0, 0].mean(axis=0)
+        else:
+            ref[c] = ref[c] - ref[c, :, 0, 0].mean(axis=0)
+    out = batch_augment.center(data, is_vector=is_vector).numpy()
+    np.testing.assert_allclose(out[0], ref, rtol=1e-12)
+    np.testing.assert_allclose(out[1], ref, rtol=1e-12)
+
+
+def test_random_shift():
+    num = 4000
+    sample, data = batch(num)
+    out = batch_augment.random_shift(
+        data, generator=torch.Generator().manual_seed(0)
+    ).numpy()
+    offset = out - sample
+    # one offset per sample and x/y axis, z untouched
+    assert np.allclose(offset[:, :2], offset[:, :2, :1, :1])
+    assert not offset[:, 2].any()
+    # uniform in [-10, 10): mean 0, std 20 / sqrt(12), within 4 standard errors
+    offset = offset[:, :2, 0, 0, 0]
+    assert offset.min() >= -10 and offset.max() < 10
+    assert np.abs(offset.mean(axis=0)).max() < 4 * (20 / np.sqrt(12)) / np.sqrt(num)
+    assert np.abs(offset.std(axis=0) - 20 / np.sqrt(12)).max() < 0.2
+
+
+def test_random_move_matches_per_sample():
+    num = 4000
+    np.random.seed(0)
+    sample, data = batch(num, V=5)
+    ref = np.stack([tools.random_move(sample.copy()) for _ in range(num)])
+    out = batch_augment.random_move(
+        data, generator=torch.Generator().manual_seed(0)
+    ).numpy()
+    # per-element mean and std over the draws, relative to their largest value
+    for f, tol in ((np.mean, 0.01), (np.std, 0.05)):
+        a, b = f(ref, axis=0), f(out, axis=0)
+        assert np.abs(a - b).max() / np.abs(a).max() < tol, f.__name__
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import torch
+
+from model import export
+
+
+def inputs(batch_size, seed=0):
+    # (N, C, T, V, M) of the conftest model
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((batch_size, 3, 16, 27, 1)).astype(np.float32)
+
+
+def eager(model, x):
+    with torch.no_grad():
+        return model(torch.from_numpy(x), 1.0).numpy()
+
+
+@pytest.mark.parametrize("format", ["torchscript", "onnx"])
+def test_export_matches_eager(model, tmp_path, format):
+    if format == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    path = str(tmp_path / "model.{}".format(format))
+    export.export(
+        export.inference_graph(model), path, format, torch.from_numpy(inputs(2))
+    )
+    run = export.load(path, format)
+    # the batch axis stays dynamic, so sizes other than the traced one work
+    for batch_size in [1, 2, 5]:
+        x = inputs(batch_size, seed=batch_size)
+        score = eager(model, x)
+        diff = np.abs(run(x) - score).max() / np.abs(score).max()
+        assert diff < 1e-5, batch_size
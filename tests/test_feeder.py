@@ -0,0 +1,59 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from feeders import materialize, pack
+from feeders.feeder import Feeder, PackedFeeder
+
+
+@pytest.fixture
+def padded(tmp_path):
+    # (N, C, T, V, M) samples with null frames before and after the sign
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(4, 3, 20, 27, 1)).astype(np.float32) * 100
+    data[0, :, :3] = 0
+    data[0, :, 15:] = 0
+    data[1, :, 12:] = 0
+    data[2] = 0
+    data_path = str(tmp_path / "train_data_joint.npy")
+    label_path = str(tmp_path / "train_label.pkl")
+    np.save(data_path, data)
+    with open(label_path, "wb") as f:
+        pickle.dump(([f"s{i}" for i in range(4)], [0, 1, 2, 3]), f)
+    begin, end = pack.load_spans(data_path).T
+    pack.pack(data_path, label_path, begin, end)
+    return data_path, label_path
+
+
+@pytest.mark.parametrize("bone_stream", [False, True])
+def test_valid_span_motion_matches_packed(padded, bone_stream):
+    kwargs = dict(
+        data_path=padded[0],
+        label_path=padded[1],
+        window_size=8,
+        bone_stream=bone_stream,
+        motion_stream=True,
+    )
+    feeder = Feeder(valid_span=True, **kwargs)
+    packed = PackedFeeder(**kwargs)
+    for i in range(len(feeder)):
+        np.testing.assert_array_equal(feeder.get_stream(i), packed.get_stream(i))
+        np.testing.assert_array_equal(feeder[i][0], packed[i][0])
+    # the last valid frame has no successor to move to
+    assert not feeder.get_stream(0)[:, -1].any()
+
+
+def test_valid_span_materialized_motion(padded):
+    data_path, label_path = padded
+    materialize.materialize(data_path, "motion")
+    kwargs = dict(
+        data_path=data_path,
+        label_path=label_path,
+        motion_stream=True,
+        valid_span=True,
+    )
+    derived = Feeder(**kwargs)
+    stored = Feeder(use_materialized=True, **kwargs)
+    for i in range(len(derived)):
+        np.testing.assert_array_equal(derived.get_stream(i), stored.get_stream(i))
@@ -0,0 +1,62 @@
+import torch
+import torch.nn as nn
+
+from model import fstgan
+from model.fuse import fuse_for_inference
+from tests.conftest import MODEL_ARGS
+
+
+def batch_norms(model):
+    return [
+        name
+        for name, m in model.named_modules()
+        if isinstance(m, nn.modules.batchnorm._BatchNorm)
+    ]
+
+
+def inputs(batch_size=4, seed=1):
+    g = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, 3, 16, 27, 1, generator=g)
+
+
+def assert_parity(fused, model, x):
+    with torch.no_grad():
+        expected, actual = model(x, 1.0), fused(x, 1.0)
+    rel = (actual - expected).norm() / expected.norm()
+    assert rel < 1e-5, rel
+
+
+def branch_state_dict(model):
+    # the state dict as the per-branch MSTCN saved it: branches.<i>.conv / .bn
+    state = model.state_dict()
+    for prefix, m in model.named_modules():
+        if not isinstance(m, fstgan.MSTCN):
+            continue
+        kernel_size = max(m.kernel_sizes)
+        for key in [k for k in state if k.startswith(prefix + ".")]:
+            value = state.pop(key)
+            rest = key[len(prefix) + 1 :]
+            for i, k in enumerate(m.kernel_sizes):
+                part = value.chunk(m.num_branches)[i] if value.dim() else value
+                if rest == "conv.weight":
+                    part = part[:, :, (kernel_size - k) // 2 : (kernel_size + k) // 2]
+                state[f"{prefix}.branches.{i}.{rest}"] = part.clone()
+    return state
+
+
+def test_fused_model_matches_eager(model):
+    fused = fuse_for_inference(model)
+    # data_bn and the unit_tcn_skip of the strided block are folded too
+    assert isinstance(model.layers[1].residual, fstgan.unit_tcn_skip)
+    assert "data_bn" in batch_norms(model)
+    assert all(name.endswith("san.bn") for name in batch_norms(fused))
+    assert_parity(fused, model, inputs())
+    assert "data_bn" in batch_norms(model)
+
+
+def test_fused_branch_checkpoint_matches_eager(model):
+    state = branch_state_dict(model)
+    assert "layers.0.tcn.branches.1.bn.running_var" in state
+    reloaded = fstgan.Model(**MODEL_ARGS)
+    reloaded.load_state_dict(state)
+    assert_parity(fuse_for_inference(reloaded), model, inputs(batch_size=3))
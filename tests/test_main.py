@@ -0,0 +1,110 @@
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import main
+from model import fstgan
+
+MODEL_ARGS = dict(
+    num_class=10,
+    num_point=27,
+    num_person=1,
+    graph="graph.sign_27.Graph",
+    graph_args=dict(labeling_mode="spatial"),
+    inner_dim=16,
+    depth=2,
+    drop_layers=1,
+    window_size=16,
+)
+
+
+class BranchMSTCN(nn.Module):
+    # MSTCN as it was before its branches were fused into one conv
+    def __init__(self, in_channels, out_channels, kernel_sizes=[5, 7]):
+        super().__init__()
+        self.branches = nn.ModuleList(
+            [
+                fstgan.unit_tcn(
+                    in_channels,
+                    out_channels // len(kernel_sizes),
+                    kernel_size=k,
+                    num_point=27,
+                )
+                for k in kernel_sizes
+            ]
+        )
+
+
+def old_checkpoint(path, optimizer="SGD"):
+    model = fstgan.Model(**MODEL_ARGS)
+    for block in model.layers:
+        for name in ["tcn", "tcn2", "tcn3"]:
+            conv = getattr(block, name).conv
+            setattr(block, name, BranchMSTCN(conv.in_channels, conv.out_channels))
+    params = list(model.parameters())
+    if optimizer == "SGD":
+        # one param group per parameter, as Processor.load_optimizer builds it
+        opt = optim.SGD([{"params": p} for p in params], lr=0.1, momentum=0.9)
+    else:
+        opt = optim.AdamW(params, lr=0.1)
+    for p in params:
+        p.grad = torch.randn_like(p)
+    opt.step()
+    torch.save({"weights": model.state_dict(), "optimizer": opt.state_dict()}, path)
+    return model, opt
+
+
+def processor(tmp_path, weights, optimizer="SGD"):
+    arg = main.get_parser().parse_args([])
+    arg.work_dir = str(tmp_path)
+    arg.device = "cpu"
+    arg.model = "model.fstgan.Model"
+    arg.model_args = MODEL_ARGS
+    arg.weights = weights
+    arg.optimizer = optimizer
+    p = main.Processor.__new__(main.Processor)
+    p.arg = arg
+    p.load_model()
+    p.load_optimizer()
+    return p
+
+
+def test_load_old_sgd_checkpoint(tmp_path):
+    weights = str(tmp_path / "old.pt")
+    old_model, old_opt = old_checkpoint(weights)
+    p = processor(tmp_path, weights)
+
+    tcn = p.model.layers[0].tcn
+    old_tcn = old_model.layers[0].tcn
+    torch.testing.assert_close(
+        tcn.conv.bias, torch.cat([b.conv.bias for b in old_tcn.branches])
+    )
+    state = p.optimizer.state
+    assert len(state) == len(list(p.model.parameters()))
+    torch.testing.assert_close(
+        state[tcn.conv.bias]["momentum_buffer"],
+        torch.cat(
+            [old_opt.state[b.conv.bias]["momentum_buffer"] for b in old_tcn.branches]
+        ),
+    )
+    # the 5-tap branch is padded to 7 taps, like its weights
+    fused = state[tcn.conv.weight]["momentum_buffer"]
+    short = old_opt.state[old_tcn.branches[0].conv.weight]["momentum_buffer"]
+    torch.testing.assert_close(fused[: len(short), :, 1:6], short)
+    assert not fused[: len(short), :, [0, 6]].any()
+    torch.testing.assert_close(
+        state[p.model.fc.weight]["momentum_buffer"],
+        old_opt.state[old_model.fc.weight]["momentum_buffer"],
+    )
+    assert len(p.optimizer.param_groups) == len(list(p.model.parameters()))
+
+
+def test_load_old_adamw_checkpoint(tmp_path):
+    weights = str(tmp_path / "old.pt")
+    _, old_opt = old_checkpoint(weights, optimizer="AdamW")
+    p = processor(tmp_path, weights, optimizer="AdamW")
+    state = p.optimizer.state
+    assert len(state) == len(list(p.model.parameters()))
+    tcn = p.model.layers[1].tcn2
+    assert state[tcn.bn.weight]["exp_avg"].shape == tcn.bn.weight.shape
+    p.optimizer.step()
@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from torch_geometric.data import Data
+from torch_geometric.utils import get_laplacian, to_scipy_sparse_matrix
+
+from feeders import posenc
+from graph.sign_27 import Graph
+
+NUM_POINT = 27
+SPATIAL = torch.tensor(Graph().neighbor).long().T
+
+
+def replicated_graph(window, temporal="none"):
+    return posenc.replicated_edge_index(SPATIAL, NUM_POINT, window, temporal)
+
+
+def laplacian(edge_index, num_nodes, norm):
+    return (
+        to_scipy_sparse_matrix(
+            *get_laplacian(edge_index, normalization=norm, num_nodes=num_nodes)
+        )
+        .toarray()
+        .astype(np.float64)
+    )
+
+
+def test_sparse_solver_matches_dense():
+    window, k = 10, 8
+    num_nodes = window * NUM_POINT
+    edge_index = replicated_graph(window, "path")
+    L = laplacian(edge_index, num_nodes, "sym")
+    data = Data(edge_index=edge_index, num_nodes=num_nodes)
+    args = dict(
+        pe_types=["LapPE"],
+        is_undirected=True,
+        laplacian_norm_type="sym",
+        max_freqs=k,
+        eigvec_norm="L2",
+    )
+    dense_vals, _ = posenc.compute_posenc_stats(data, eigen_solver="dense", **args)
+    sparse_vals, sparse_vecs = posenc.compute_posenc_stats(
+        data, eigen_solver="sparse", **args
+    )
+    torch.testing.assert_close(sparse_vals, dense_vals, atol=1e-5, rtol=0)
+    # repeated eigenvalues leave the basis free, so check the eigen equation
+    vals = sparse_vals[0, :, 0].numpy().astype(np.float64)
+    vecs = sparse_vecs.numpy().astype(np.float64)
+    assert np.abs(L @ vecs - vecs * vals).max() < 1e-5
+
+
+def test_lap_pe_cache_is_keyed(tmp_path):
+    window = 6
+    edge_index = replicated_graph(window)
+    args = dict(num_nodes=window * NUM_POINT, cache_dir=str(tmp_path))
+    vals, vecs = posenc.lap_pe(edge_index, max_freqs=8, **args)
+    cached_vals, cached_vecs = posenc.lap_pe(edge_index, max_freqs=8, **args)
+    torch.testing.assert_close(cached_vals, vals)
+    torch.testing.assert_close(cached_vecs, vecs)
+    assert len(os.listdir(tmp_path)) == 1
+    # another setting or graph never reuses the file
+    posenc.lap_pe(edge_index, max_freqs=4, **args)
+    posenc.lap_pe(replicated_graph(window, "path"), max_freqs=8, **args)
+    assert len(os.listdir(tmp_path)) == 3
+
+
+@pytest.mark.parametrize(
+    "temporal, norm", [("none", None), ("none", "sym"), ("path", None)]
+)
+def test_product_eigenpairs_match_dense(temporal, norm):
+    window, k = 30, 40
+    L = laplacian(replicated_graph(window, temporal), window * NUM_POINT, norm)
+    dense = np.linalg.eigvalsh(L)
+    evals, evects = posenc.product_eigenpairs(
+        SPATIAL, NUM_POINT, window, temporal, norm, max_freqs=k
+    )
+    # edge weights come out of get_laplacian in float32
+    np.testing.assert_allclose(evals, dense[:k], atol=1e-6)
+    assert np.abs(L @ evects - evects * evals).max() < 1e-6
+    assert np.abs(evects.T @ evects - np.eye(k)).max() < 1e-10
+
+
+def test_product_lap_pe_falls_back_to_sparse():
+    # border frames have a lower degree, so the normalized path product is
+    # not separable and goes through the general solver
+    window, k = 10, 8
+    with pytest.raises(ValueError):
+        posenc.product_eigenpairs(SPATIAL, NUM_POINT, window, "path", "sym")
+    L = laplacian(replicated_graph(window, "path"), window * NUM_POINT, "sym")
+    vals, _ = posenc.product_lap_pe(
+        SPATIAL, NUM_POINT, window, "path", "sym", max_freqs=k
+    )
+    np.testing.assert_allclose(vals[0, :, 0], np.linalg.eigvalsh(L)[:k], atol=1e-5)
+
+
+@pytest.mark.parametrize("method", ["sparse", "hutchinson"])
+def test_rw_landing_probs_match_dense(method):
+    window = 30
+    edge_index = replicated_graph(window, "path")
+    ksteps = list(range(1, 17))
+    args = dict(num_nodes=window * NUM_POINT)
+    dense = posenc.get_rw_landing_probs(ksteps, edge_index, **args)
+    if method == "sparse":
+        probs = posenc.get_rw_landing_probs(ksteps, edge_index, method="sparse", **args)
+        torch.testing.assert_close(probs, dense, atol=1e-6, rtol=0)
+    else:
+        # unbiased estimate, within a few standard errors of 256 probes
+        probs = posenc.get_rw_landing_probs(
+            ksteps,
+            edge_index,
+            method="hutchinson",
+            num_probes=256,
+            generator=torch.Generator().manual_seed(0),
+            **args,
+        )
+        assert (probs - dense).abs().mean() < 0.02
+
+
+def test_blocked_heat_kernels():
+    window = 4
+    L = laplacian(replicated_graph(window, "path"), window * NUM_POINT, None)
+    evals, evects = (torch.from_numpy(a) for a in np.linalg.eigh(L))
+    times = [1.0, 4.0]
+    kernels, diag = posenc.get_heat_kernels(evects, evals, times, block_size=10)
+    # sum over the non-null eigenpairs of exp(-t lambda) phi phi^T
+    keep = evals >= 1e-8
+    phi, lam = evects[:, keep], evals[keep]
+    for kernel, t in zip(kernels, times):
+        torch.testing.assert_close(kernel, (phi * torch.exp(-t * lam)) @ phi.T)
+    torch.testing.assert_close(diag, torch.diagonal(kernels, dim1=1, dim2=2).T)